@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+
+# tsuserver3, an Attorney Online server
+#
+# Copyright (C) 2016 argoneus <argoneuscze@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Exports the event logs of the server database into one file per table,
+as JSON lines or CSV, optionally compressed with gzip or zstd.
+
+The database is opened read-only and everything is read inside a single
+transaction, so the export is a consistent snapshot even while the server
+keeps running. Rows are streamed straight from SQLite to the output file,
+so memory use does not depend on the size of the logs.
+
+Example:
+    python export_logs.py exports --since 2020-04-01 --area CR1 --anonymize
+"""
+
+import argparse
+import csv
+import gzip
+import hashlib
+import hmac
+import importlib.util
+import io
+import json
+import os
+import secrets
+import sqlite3
+import sys
+from glob import glob
+
+import arrow
+
+
+# Columns exported from each table. `event_subtype` is replaced by the
+# name of the subtype, and IPIDs and HDIDs are hashed when anonymizing.
+TABLES = {
+    'ic_events': ['event_time', 'ipid', 'room_name', 'char_name', 'ic_name',
+                  'message'],
+    'room_events': ['event_time', 'ipid', 'target_ipid', 'room_name',
+                    'char_name', 'ooc_name', 'event_subtype', 'message'],
+    'misc_events': ['event_time', 'ipid', 'target_ipid', 'event_subtype',
+                    'event_data'],
+    'connect_events': ['event_time', 'ipid', 'hdid', 'failed']
+}
+SUBTYPE_TABLES = {
+    'room_events': 'room_event_types',
+    'misc_events': 'misc_event_types'
+}
+IDENTITY_COLUMNS = ('ipid', 'target_ipid', 'hdid')
+EXTENSIONS = {'gzip': '.gz', 'zstd': '.zst', 'none': ''}
+
+
+def open_snapshot(path):
+    """
+    Open a database read-only and start a read transaction, which keeps
+    seeing the same data until it ends.
+    """
+    conn = sqlite3.connect(f'file:{path}?mode=ro', uri=True,
+                           isolation_level=None)
+    conn.execute('BEGIN')
+    return conn
+
+
+def load_subtypes(conn):
+    """Map the subtype IDs of each event table to their names."""
+    return {table: dict(conn.execute(f'SELECT type_id, type_name FROM {types}'))
+            for table, types in SUBTYPE_TABLES.items()}
+
+
+def open_output(path, compression):
+    """Open a text file for writing, compressing it if asked to."""
+    if compression == 'gzip':
+        return gzip.open(path, 'wt', encoding='utf-8', newline='')
+    if compression == 'zstd':
+        import zstandard
+        stream = zstandard.ZstdCompressor().stream_writer(open(path, 'wb'))
+        return io.TextIOWrapper(stream, encoding='utf-8', newline='')
+    return open(path, 'w', encoding='utf-8', newline='')
+
+
+def table_rows(conn, table, args):
+    """
+    Stream the rows of a table that match the time and area filters.
+    Tables without an area are skipped when filtering by area.
+    """
+    columns = TABLES[table]
+    try:
+        conn.execute(f'SELECT 1 FROM {table} LIMIT 0')
+    except sqlite3.OperationalError:
+        # Archives only have the tables that had events that month.
+        return
+    where = []
+    params = []
+    if args.since is not None:
+        where.append('event_time >= ?')
+        params.append(args.since)
+    if args.until is not None:
+        where.append('event_time < ?')
+        params.append(args.until)
+    if args.area is not None:
+        if 'room_name' not in columns:
+            return
+        where.append('room_name = ? COLLATE NOCASE')
+        params.append(args.area)
+    query = f'SELECT {", ".join(columns)} FROM {table}'
+    if where:
+        query += ' WHERE ' + ' AND '.join(where)
+    query += ' ORDER BY rowid'
+    yield from conn.execute(query, params)
+
+
+def export_table(sources, table, subtypes, args):
+    """Write every matching row of a table to its own output file."""
+    columns = TABLES[table]
+    extension = 'jsonl' if args.format == 'jsonl' else 'csv'
+    path = os.path.join(args.output,
+                        f'{table}.{extension}{EXTENSIONS[args.compress]}')
+
+    def anonymize(value):
+        if value is None:
+            return None
+        return hmac.new(args.key, str(value).encode('utf-8'),
+                        hashlib.sha256).hexdigest()[:16]
+
+    count = 0
+    with open_output(path, args.compress) as out:
+        if args.format == 'csv':
+            writer = csv.writer(out)
+            writer.writerow(columns)
+        for conn in sources:
+            for row in table_rows(conn, table, args):
+                record = dict(zip(columns, row))
+                if 'event_subtype' in record:
+                    record['event_subtype'] = subtypes[table].get(
+                        record['event_subtype'], record['event_subtype'])
+                if args.anonymize:
+                    for column in IDENTITY_COLUMNS:
+                        if column in record:
+                            record[column] = anonymize(record[column])
+                if args.format == 'csv':
+                    writer.writerow(record.values())
+                else:
+                    out.write(json.dumps(record, ensure_ascii=False) + '\n')
+                count += 1
+    print(f'{table}: {count} rows written to {path}')
+
+
+def parse_time(value):
+    """Turn a date given on the command line into the database format."""
+    try:
+        return arrow.get(value).format('YYYY-MM-DD HH:mm:ss')
+    except (arrow.parser.ParserError, ValueError):
+        raise argparse.ArgumentTypeError(f'invalid date: {value}')
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Export tsuserver3 event logs.')
+    parser.add_argument('output',
+                        help='directory to write one file per table into')
+    parser.add_argument('--db', default='storage/db.sqlite3',
+                        help='database to export (default: %(default)s)')
+    parser.add_argument('--tables', nargs='+', choices=list(TABLES),
+                        default=list(TABLES), help='tables to export')
+    parser.add_argument('--format', choices=['jsonl', 'csv'], default='jsonl')
+    parser.add_argument('--compress', choices=list(EXTENSIONS),
+                        default='gzip')
+    parser.add_argument('--since', type=parse_time,
+                        help='only export events at or after this date (UTC)')
+    parser.add_argument('--until', type=parse_time,
+                        help='only export events before this date (UTC)')
+    parser.add_argument('--area',
+                        help='only export events in the area with this '
+                             'abbreviation; skips tables without areas')
+    parser.add_argument('--archives', action='store_true',
+                        help='also export events moved to storage/archive')
+    parser.add_argument('--anonymize', action='store_true',
+                        help='replace IPIDs and HDIDs with keyed hashes')
+    parser.add_argument('--key',
+                        help='key for --anonymize, to get the same hashes '
+                             'across exports (default: random)')
+    args = parser.parse_args()
+    args.key = (args.key or secrets.token_hex(16)).encode('utf-8')
+
+    if not os.path.exists(args.db):
+        sys.exit(f'{args.db} does not exist.')
+    if args.compress == 'zstd' and importlib.util.find_spec('zstandard') is None:
+        sys.exit('zstd compression needs the zstandard package: '
+                 'pip install zstandard')
+    os.makedirs(args.output, exist_ok=True)
+
+    main_db = open_snapshot(args.db)
+    subtypes = load_subtypes(main_db)
+    sources = []
+    if args.archives:
+        archive_dir = os.path.join(os.path.dirname(args.db), 'archive')
+        sources += [open_snapshot(path) for path in
+                    sorted(glob(os.path.join(archive_dir, 'events-*.sqlite3')))]
+    sources.append(main_db)
+
+    try:
+        for table in args.tables:
+            export_table(sources, table, subtypes, args)
+    finally:
+        for conn in sources:
+            conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,32 @@
+-- Indexes for looking up the history of an IPID, newest first.
+-- Without them, these lookups scan the whole event table and sort it.
+--
+-- EXPLAIN QUERY PLAN
+--   SELECT ooc_name FROM room_events
+--   WHERE ipid = ? AND ooc_name IS NOT NULL AND ooc_name != ''
+--   ORDER BY event_time DESC LIMIT 1
+-- before: SCAN room_events
+--         USE TEMP B-TREE FOR ORDER BY
+-- after:  SEARCH room_events USING INDEX room_events_ipid (ipid=?)
+--
+-- The same applies to ic_events, connect_events and misc_events.
+--
+-- No VACUUM here: creating an index does not leave free pages behind,
+-- and a VACUUM would rewrite the entire database before the server starts.
+
+CREATE INDEX IF NOT EXISTS room_events_ipid
+	ON room_events(ipid, event_time);
+CREATE INDEX IF NOT EXISTS ic_events_ipid
+	ON ic_events(ipid, event_time);
+CREATE INDEX IF NOT EXISTS connect_events_ipid
+	ON connect_events(ipid, event_time);
+CREATE INDEX IF NOT EXISTS misc_events_ipid
+	ON misc_events(ipid, event_time);
+
+-- Deleting an IPID cascades to events where it is the target.
+CREATE INDEX IF NOT EXISTS room_events_target_ipid
+	ON room_events(target_ipid);
+CREATE INDEX IF NOT EXISTS misc_events_target_ipid
+	ON misc_events(target_ipid);
+
+PRAGMA user_version = 4;
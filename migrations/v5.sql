@@ -0,0 +1,80 @@
+-- Full-text indexes over IC messages and room event messages.
+-- They are external content tables, so the text itself is only stored
+-- once, in ic_events and room_events. The triggers keep the indexes up
+-- to date as events are logged, archived or deleted along with an IPID.
+-- room_name, ipid and event_time are UNINDEXED and only read back from
+-- the event tables; searches filter on the event rows instead.
+
+CREATE VIRTUAL TABLE IF NOT EXISTS ic_events_fts USING fts5(
+	message,
+	room_name UNINDEXED,
+	ipid UNINDEXED,
+	event_time UNINDEXED,
+	content='ic_events'
+);
+
+CREATE TRIGGER IF NOT EXISTS ic_events_fts_insert AFTER INSERT ON ic_events
+BEGIN
+	INSERT INTO ic_events_fts(rowid, message, room_name, ipid, event_time)
+	VALUES (new.rowid, new.message, new.room_name, new.ipid, new.event_time);
+END;
+
+CREATE TRIGGER IF NOT EXISTS ic_events_fts_delete AFTER DELETE ON ic_events
+BEGIN
+	INSERT INTO ic_events_fts(ic_events_fts, rowid, message, room_name,
+		ipid, event_time)
+	VALUES ('delete', old.rowid, old.message, old.room_name, old.ipid,
+		old.event_time);
+END;
+
+CREATE TRIGGER IF NOT EXISTS ic_events_fts_update AFTER UPDATE ON ic_events
+BEGIN
+	INSERT INTO ic_events_fts(ic_events_fts, rowid, message, room_name,
+		ipid, event_time)
+	VALUES ('delete', old.rowid, old.message, old.room_name, old.ipid,
+		old.event_time);
+	INSERT INTO ic_events_fts(rowid, message, room_name, ipid, event_time)
+	VALUES (new.rowid, new.message, new.room_name, new.ipid, new.event_time);
+END;
+
+CREATE VIRTUAL TABLE IF NOT EXISTS room_events_fts USING fts5(
+	message,
+	room_name UNINDEXED,
+	ipid UNINDEXED,
+	event_time UNINDEXED,
+	content='room_events'
+);
+
+CREATE TRIGGER IF NOT EXISTS room_events_fts_insert AFTER INSERT ON room_events
+BEGIN
+	INSERT INTO room_events_fts(rowid, message, room_name, ipid, event_time)
+	VALUES (new.rowid, new.message, new.room_name, new.ipid, new.event_time);
+END;
+
+CREATE TRIGGER IF NOT EXISTS room_events_fts_delete AFTER DELETE ON room_events
+BEGIN
+	INSERT INTO room_events_fts(room_events_fts, rowid, message, room_name,
+		ipid, event_time)
+	VALUES ('delete', old.rowid, old.message, old.room_name, old.ipid,
+		old.event_time);
+END;
+
+CREATE TRIGGER IF NOT EXISTS room_events_fts_update AFTER UPDATE ON room_events
+BEGIN
+	INSERT INTO room_events_fts(room_events_fts, rowid, message, room_name,
+		ipid, event_time)
+	VALUES ('delete', old.rowid, old.message, old.room_name, old.ipid,
+		old.event_time);
+	INSERT INTO room_events_fts(rowid, message, room_name, ipid, event_time)
+	VALUES (new.rowid, new.message, new.room_name, new.ipid, new.event_time);
+END;
+
+-- Index the events logged before this migration. This reads and
+-- tokenizes every IC message and room event in one transaction, during
+-- server startup. It takes roughly a second per few hundred thousand
+-- events and prints nothing while it runs, so a large database can
+-- hold up the first start after updating for several minutes.
+INSERT INTO ic_events_fts(ic_events_fts) VALUES ('rebuild');
+INSERT INTO room_events_fts(room_events_fts) VALUES ('rebuild');
+
+PRAGMA user_version = 5;
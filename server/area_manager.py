@@ -88,6 +88,14 @@ class AreaManager:
 
             self.owners = []
             self.afkers = []
+
+            # Which client holds each taken character, and the CharsCheck
+            # list built from it (-1 for taken, 0 for free). Both are kept
+            # up to date as clients join, leave and switch characters; the
+            # encoded packet is rebuilt the next time it is sent.
+            self.char_holders = {}
+            self.char_status = []
+            self.chars_check_packet = None
         class Locked(Enum):
             """Lock state of an area."""
             FREE = 1,
@@ -97,13 +105,16 @@ class AreaManager:
         def new_client(self, client):
             """Add a client to the area."""
             self.clients.add(client)
-            self.server.area_manager.send_arup_players()
+            self.take_char(client, client.char_id)
+            self.server.area_manager.send_arup_players(self)
             if client.char_id != -1:
                 database.log_room('area.join', client, self)
 
         def remove_client(self, client):
             """Remove a disconnected client from the area."""
             self.clients.remove(client)
+            self.release_char(client, client.char_id)
+            self.server.area_manager.send_arup_players(self)
             if client in self.afkers:
                 self.afkers.remove(client)
             if len(self.clients) == 0:
@@ -116,7 +127,7 @@ class AreaManager:
             self.is_locked = self.Locked.FREE
             self.blankposting_allowed = True
             self.invite_list = {}
-            self.server.area_manager.send_arup_lock()
+            self.server.area_manager.send_arup_lock(self)
             self.broadcast_ooc('This area is open now.')
 
         def spectator(self):
@@ -126,7 +137,7 @@ class AreaManager:
                 self.invite_list[i.id] = None
             for i in self.owners:
                 self.invite_list[i.id] = None
-            self.server.area_manager.send_arup_lock()
+            self.server.area_manager.send_arup_lock(self)
             self.broadcast_ooc('This area is spectatable now.')
 
         def lock(self):
@@ -136,7 +147,7 @@ class AreaManager:
                 self.invite_list[i.id] = None
             for i in self.owners:
                 self.invite_list[i.id] = None
-            self.server.area_manager.send_arup_lock()
+            self.server.area_manager.send_arup_lock(self)
             self.broadcast_ooc('This area is locked now.')
 
         def is_char_available(self, char_id):
@@ -144,13 +155,67 @@ class AreaManager:
             Check if a character is available for use.
             :param char_id: character ID
             """
-            return char_id not in [x.char_id for x in self.clients]
+            return char_id not in self.char_holders
+
+        def take_char(self, client, char_id):
+            """
+            Mark a character as held by a client in this area.
+            :param client: client using the character
+            :param char_id: character ID, or -1 for none
+            """
+            if char_id == -1:
+                return
+            self.char_holders[char_id] = client
+            self._set_char_status(char_id, -1)
+
+        def release_char(self, client, char_id):
+            """
+            Mark a character as free again, if the client was holding it.
+            :param client: client leaving the character
+            :param char_id: character ID, or -1 for none
+            """
+            if self.char_holders.get(char_id) is client:
+                del self.char_holders[char_id]
+                self._set_char_status(char_id, 0)
+
+        def _set_char_status(self, char_id, status):
+            if char_id < len(self.char_status):
+                self.char_status[char_id] = status
+            self.chars_check_packet = None
+
+        def get_char_status(self):
+            """
+            Get the CharsCheck list of the area: -1 for each character that
+            is taken and 0 for each one that is free.
+            """
+            char_count = len(self.server.char_list)
+            if len(self.char_status) != char_count:
+                # The character list was (re)loaded since the last call.
+                self.char_status = [0] * char_count
+                for char_id in self.char_holders:
+                    if char_id < char_count:
+                        self.char_status[char_id] = -1
+                self.chars_check_packet = None
+            return self.char_status
+
+        def get_chars_check_packet(self):
+            """Get the encoded CharsCheck packet of the area."""
+            status = self.get_char_status()
+            if self.chars_check_packet is None:
+                self.chars_check_packet = \
+                    self.server.client_manager.Client.encode_command(
+                        'CharsCheck', *status)
+            return self.chars_check_packet
+
+        def send_chars_check(self):
+            """Tell every client in the area which characters are free."""
+            for c in self.clients:
+                c.send_chars_check()
 
         def get_rand_avail_char_id(self):
             """Get a random available character ID."""
             avail_set = set(range(len(
-                self.server.char_list))) - {x.char_id
-                                            for x in self.clients}
+                self.server.char_list))) - self.char_holders.keys()
             if len(avail_set) == 0:
                 raise AreaError('No available characters.')
             return random.choice(tuple(avail_set))
@@ -159,17 +224,16 @@ class AreaManager:
             """
             Broadcast an AO-compatible command to all clients in the area.
             """
-            for c in self.clients:
-                c.send_command(cmd, *args)
+            self.server.client_manager.broadcast_command(self.clients, cmd,
+                                                         *args)
 
         def send_owner_command(self, cmd, *args):
             """
             Send an AO-compatible command to all owners of the area
             that are not currently in the area.
             """
-            for c in self.owners:
-                if c not in self.clients:
-                    c.send_command(cmd, *args)
+            self.server.client_manager.broadcast_command(
+                [c for c in self.owners if c not in self.clients], cmd, *args)
 
         def broadcast_ooc(self, msg):
             """
@@ -400,7 +464,7 @@ class AreaManager:
             if value.lower() == 'lfp':
                 value = 'looking-for-players'
             self.status = value.upper()
-            self.server.area_manager.send_arup_status()
+            self.server.area_manager.send_arup_status(self)
 
         def change_doc(self, doc='No document.'):
             """
@@ -478,12 +542,30 @@ class AreaManager:
                 self.chance = 1
                 self.showname = showname
 
+    # ARUP kinds, which are also the first argument of the packet.
+    ARUP_PLAYERS = 0
+    ARUP_STATUS = 1
+    ARUP_CMS = 2
+    ARUP_LOCK = 3
+
     def __init__(self, server):
         self.server = server
         self.cur_id = 0
         self.areas = []
+        self.areas_by_id = {}
+        self.areas_by_name = {}
+        self.areas_by_folded_name = {}
+        self.areas_by_abbreviation = {}
         self.load_areas()
 
+        # ARUP updates are coalesced: changes only mark the affected
+        # areas as dirty for that kind of update, and a single packet per
+        # kind is broadcast at most once every arup_interval_ms.
+        self.arup_sent = {}
+        self.arup_dirty = {}
+        self.arup_handle = None
+        self.arup_last_flush = 0
+
     def load_areas(self):
         """Create all areas from a YAML file."""
         with open('config/areas.yaml', 'r') as chars:
@@ -515,24 +597,76 @@ class AreaManager:
                           item['shouts_allowed'], item['jukebox'],
                           item['abbreviation'], item['noninterrupting_pres']))
             self.cur_id += 1
+        self.index_areas()
+
+    def index_areas(self):
+        """
+        Rebuild the lookup tables of areas by ID, name and abbreviation.
+        The tables are swapped in all at once. If several areas share a
+        name, the first one wins.
+        """
+        by_id = {}
+        by_name = {}
+        by_folded_name = {}
+        by_abbreviation = {}
+        for area in self.areas:
+            by_id[area.id] = area
+            by_name.setdefault(area.name, area)
+            by_folded_name.setdefault(str(area.name).casefold(), area)
+            by_abbreviation.setdefault(str(area.abbreviation).casefold(),
+                                       area)
+        self.areas_by_id, self.areas_by_name, self.areas_by_folded_name, \
+            self.areas_by_abbreviation = \
+            by_id, by_name, by_folded_name, by_abbreviation
 
     def default_area(self):
         """Get the default area."""
         return self.areas[0]
 
-    def get_area_by_name(self, name):
-        """Get an area by name."""
-        for area in self.areas:
-            if area.name == name:
-                return area
-        raise AreaError('Area not found.')
+    def get_area_by_name(self, name, case_sensitive=True):
+        """
+        Get an area by name.
+        :param name: area name
+        :param case_sensitive: whether the case of the name must match
+        (Default value = True)
+        """
+        if case_sensitive:
+            area = self.areas_by_name.get(name)
+        else:
+            area = self.areas_by_folded_name.get(name.casefold())
+        if area is None:
+            raise AreaError('Area not found.')
+        return area
 
     def get_area_by_id(self, num):
         """Get an area by ID."""
-        for area in self.areas:
-            if area.id == num:
-                return area
-        raise AreaError('Area not found.')
+        try:
+            return self.areas_by_id[num]
+        except KeyError:
+            raise AreaError('Area not found.')
+
+    def get_area_by_abbreviation(self, abbreviation):
+        """Get an area by its abbreviation, ignoring case."""
+        try:
+            return self.areas_by_abbreviation[abbreviation.casefold()]
+        except KeyError:
+            raise AreaError('Area not found.')
+
+    def find_area(self, key):
+        """
+        Get an area from whatever a user typed to refer to it: its ID,
+        its abbreviation or its name, ignoring case.
+        :param key: area ID, abbreviation or name
+        """
+        if key.isdigit():
+            try:
+                return self.get_area_by_id(int(key))
+            except AreaError:
+                pass
+        try:
+            return self.get_area_by_abbreviation(key)
+        except AreaError:
+            return self.get_area_by_name(key, case_sensitive=False)
 
     def abbreviate(self, name):
         """Abbreviate the name of a room."""
@@ -556,36 +690,106 @@ class AreaManager:
         :param *args: command arguments
         """
         for a_id in area_ids:
-            self.get_area_by_id(a_id).send_command(cmd, *args)
-            self.get_area_by_id(a_id).send_owner_command(cmd, *args)
+            area = self.get_area_by_id(a_id)
+            area.send_command(cmd, *args)
+            area.send_owner_command(cmd, *args)
 
-    def send_arup_players(self):
-        """Broadcast ARUP packet containing player counts."""
-        players_list = [0]
-        for area in self.areas:
-            players_list.append(len(area.clients))
-        self.server.send_arup(players_list)
+    def get_arup_value(self, kind, area):
+        """
+        Get what an ARUP packet of a given kind says about an area.
+        :param kind: one of the ARUP_* kinds
+        :param area: area to describe
+        """
+        if kind == self.ARUP_PLAYERS:
+            return len(area.clients)
+        if kind == self.ARUP_STATUS:
+            return area.status
+        if kind == self.ARUP_CMS:
+            if len(area.owners) > 0:
+                return area.get_cms()
+            return 'FREE'
+        return area.is_locked.name
 
-    def send_arup_status(self):
-        """Broadcast ARUP packet containing area statuses."""
-        status_list = [1]
-        for area in self.areas:
-            status_list.append(area.status)
-        self.server.send_arup(status_list)
+    def mark_arup_dirty(self, kind, area=None):
+        """
+        Schedule an ARUP update for some areas. Updates of the same kind
+        are merged into one packet, sent at most once per interval.
+        :param kind: one of the ARUP_* kinds
+        :param area: area that changed, or None for all of them
+        """
+        dirty = self.arup_dirty.setdefault(kind, set())
+        if area is None:
+            dirty.update(self.areas)
+        else:
+            dirty.add(area)
+        if self.arup_handle is None:
+            interval = self.server.config['arup_interval_ms'] / 1000
+            delay = self.arup_last_flush + interval - time.monotonic()
+            self.arup_handle = asyncio.get_event_loop().call_later(
+                max(delay, 0), self.flush_arup)
+
+    def flush_arup(self):
+        """
+        Broadcast one ARUP packet for every kind with dirty areas whose
+        values actually changed since they were last sent.
+        """
+        if self.arup_handle is not None:
+            self.arup_handle.cancel()
+            self.arup_handle = None
+        self.arup_last_flush = time.monotonic()
+        dirty, self.arup_dirty = self.arup_dirty, {}
+        for kind in sorted(dirty):
+            values = self.arup_sent.get(kind)
+            if values is None:
+                values = self.arup_sent[kind] = {
+                    area: self.get_arup_value(kind, area)
+                    for area in self.areas}
+            else:
+                changed = False
+                for area in dirty[kind]:
+                    value = self.get_arup_value(kind, area)
+                    if values.get(area) != value:
+                        values[area] = value
+                        changed = True
+                if not changed:
+                    continue
+            self.server.send_arup([kind] +
+                                  [values[area] for area in self.areas])
+
+    def send_arup_to(self, client):
+        """
+        Send the current state of every area to a single client.
+        :param client: recipient
+        """
+        for kind in (self.ARUP_PLAYERS, self.ARUP_STATUS, self.ARUP_CMS,
+                     self.ARUP_LOCK):
+            client.send_command('ARUP', kind, *[
+                self.get_arup_value(kind, area) for area in self.areas])
 
-    def send_arup_cms(self):
-        """Broadcast ARUP packet containing area CMs."""
-        cms_list = [2]
-        for area in self.areas:
-            cm = 'FREE'
-            if len(area.owners) > 0:
-                cm = area.get_cms()
-            cms_list.append(cm)
-        self.server.send_arup(cms_list)
+    def send_arup_players(self, area=None):
+        """
+        Broadcast ARUP packet containing player counts.
+        :param area: area that changed, or None for all of them
+        """
+        self.mark_arup_dirty(self.ARUP_PLAYERS, area)
 
-    def send_arup_lock(self):
-        """Broadcast ARUP packet containing the lock status of each area."""
-        lock_list = [3]
-        for area in self.areas:
-            lock_list.append(area.is_locked.name)
-        self.server.send_arup(lock_list)
+    def send_arup_status(self, area=None):
+        """
+        Broadcast ARUP packet containing area statuses.
+        :param area: area that changed, or None for all of them
+        """
+        self.mark_arup_dirty(self.ARUP_STATUS, area)
+
+    def send_arup_cms(self, area=None):
+        """
+        Broadcast ARUP packet containing area CMs.
+        :param area: area that changed, or None for all of them
+        """
+        self.mark_arup_dirty(self.ARUP_CMS, area)
+
+    def send_arup_lock(self, area=None):
+        """
+        Broadcast ARUP packet containing the lock status of each area.
+        :param area: area that changed, or None for all of them
+        """
+        self.mark_arup_dirty(self.ARUP_LOCK, area)
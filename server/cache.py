@@ -0,0 +1,80 @@
+# tsuserver3, an Attorney Online server
+#
+# Copyright (C) 2016 argoneus <argoneuscze@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+    """
+    A bounded mapping that drops the least recently used entry once it
+    is full. Entries also expire `ttl` seconds after they were stored.
+    """
+    _missing = object()
+
+    def __init__(self, maxsize, ttl=None, clock=time.monotonic):
+        """
+        :param maxsize: maximum number of entries kept
+        :param ttl: seconds an entry stays valid, or None to keep it
+        until it is pushed out
+        :param clock: function returning the current time in seconds
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self.entries = OrderedDict()
+
+    def get(self, key, default=None):
+        """
+        Look up a key, marking it as recently used.
+        :param key: key to look up
+        :param default: returned if the key is missing or expired
+        """
+        try:
+            value, expires = self.entries[key]
+        except KeyError:
+            return default
+        if expires is not None and expires <= self.clock():
+            del self.entries[key]
+            return default
+        self.entries.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        """
+        Store a value, evicting the least recently used entry if the
+        cache is over its size.
+        :param key: key to store under
+        :param value: value to store
+        """
+        if self.maxsize <= 0:
+            return
+        expires = None if self.ttl is None else self.clock() + self.ttl
+        self.entries[key] = (value, expires)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        """Forget every entry."""
+        self.entries.clear()
+
+    def __contains__(self, key):
+        return self.get(key, self._missing) is not self._missing
+
+    def __len__(self):
+        return len(self.entries)
@@ -15,8 +15,10 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import asyncio
 import re
 import time
+from contextlib import contextmanager
 from heapq import heappop, heappush
 
 from server import database
@@ -34,12 +36,12 @@ class ClientManager:
         def __init__(self, server, transport, user_id, ipid):
             self.is_checked = False
             self.transport = transport
-            self.hdid = ''
+            self._hdid = ''
             self.id = user_id
-            self.char_id = -1
+            self._char_id = -1
             self.area = server.area_manager.default_area()
             self.server = server
-            self.name = ''
+            self._name = ''
             self.fake_name = ''
             self.is_mod = False
             self.mod_profile_name = None
@@ -91,15 +93,133 @@ class ClientManager:
                 for x in range(self.server.config['wtce_floodguard']
                                ['times_per_interval'])
             ]
-            # security stuff
-            self.clientscon = 0
+            # Packets waiting to be written out at the end of the current
+            # event loop iteration, or once the transport has drained.
+            self.out_buffer = []
+            self.out_buffer_size = 0
+            self.flush_handle = None
+            self.writing_paused = False
+            self.congested_since = None
+            self.dropped_packets = 0
+            # Number of packets dropped during the current congestion.
+            # ARUP is only sent when an area changes, so the full area
+            # state is resent once the client catches up.
+            self.dropped_while_congested = 0
+
+        @staticmethod
+        def encode_command(command, *args):
+            """
+            Serialize an AO-compatible message, with arguments
+            delimited by `#` and ending with `#%`.
+            :param command: command name
+            :param *args: list of arguments
+            :returns: encoded packet as bytes
+            """
+            if args:
+                msg = f'{command}#{"#".join([str(x) for x in args])}#%'
+            else:
+                msg = f'{command}#%'
+            return msg.encode('utf-8')
+
+        @staticmethod
+        def is_personalized(command, args):
+            """
+            Check if a command must be serialized separately for each
+            recipient (MS carries an evidence index that is remapped to
+            the recipient's own evidence list).
+            :param command: command name
+            :param args: list of arguments
+            """
+            return command == 'MS' and len(args) > 11 and args[11] != 0
+
+        @property
+        def send_queue_size(self):
+            """Get the number of bytes still waiting to be sent."""
+            return self.out_buffer_size + \
+                self.transport.get_write_buffer_size()
+
+        def send_packet(self, packet, droppable=False):
+            """
+            Queue an already encoded packet for sending. Everything queued
+            during the same event loop iteration is written to the
+            transport in one go.
+            :param packet: bytes to send
+            :param droppable: whether the packet may be skipped while the
+            client is not keeping up (Default value = False)
+            """
+            if droppable and self.congested_since is not None:
+                self.dropped_packets += 1
+                self.dropped_while_congested += 1
+                return
+            self.out_buffer.append(packet)
+            self.out_buffer_size += len(packet)
+            if self.writing_paused:
+                self.check_send_queue()
+            elif self.flush_handle is None:
+                self.flush_handle = asyncio.get_event_loop().call_soon(
+                    self.flush)
+
+        def flush(self, final=False):
+            """
+            Write all queued packets to the transport at once, unless the
+            transport has asked us to stop writing.
+            :param final: write even if the transport asked us to stop,
+            because the connection is about to be closed (Default value =
+            False)
+            """
+            if self.flush_handle is not None:
+                self.flush_handle.cancel()
+                self.flush_handle = None
+            if (self.writing_paused and not final) or not self.out_buffer:
+                return
+            packets, self.out_buffer = self.out_buffer, []
+            self.out_buffer_size = 0
+            self.transport.write(b''.join(packets))
+            if not final:
+                self.check_send_queue()
+
+        def check_send_queue(self):
+            """
+            Keep track of whether the client is falling behind on outgoing
+            data, and disconnect it if it stays behind for too long or its
+            queue grows past the hard limit.
+            """
+            if self.transport.is_closing():
+                return
+            limits = self.server.config['send_queue']
+            queued = self.send_queue_size
+            if self.congested_since is None:
+                if queued > limits['high_watermark']:
+                    self.congested_since = time.time()
+            elif queued <= limits['low_watermark']:
+                self.congested_since = None
+                if self.dropped_while_congested > 0:
+                    self.dropped_while_congested = 0
+                    self.server.area_manager.send_arup_to(self)
+            elif time.time() - self.congested_since > limits['evict_after']:
+                self.evict(queued)
+                return
+            if queued > limits['max_size']:
+                self.evict(queued)
+
+        def evict(self, queued):
+            """
+            Drop the connection of a client that cannot keep up.
+            :param queued: number of bytes waiting to be sent
+            """
+            database.log_misc('evict', target=self,
+                              data={'queued': queued,
+                                    'dropped': self.dropped_packets})
+            self.out_buffer = []
+            self.out_buffer_size = 0
+            self.transport.abort()
 
         def send_raw_message(self, msg):
             """
             Send a raw packet over TCP.
             :param msg: string to send
             """
-            self.transport.write(msg.encode('utf-8'))
+            self.send_packet(msg.encode('utf-8'))
 
         def send_command(self, command, *args):
             """
@@ -108,18 +228,16 @@ class ClientManager:
             :param command: command name
             :param *args: list of arguments
             """
-            if args:
-                if command == 'MS':
-                    for evi_num in range(len(self.evi_list)):
-                        if self.evi_list[evi_num] == args[11]:
-                            lst = list(args)
-                            lst[11] = evi_num
-                            args = tuple(lst)
-                            break
-                self.send_raw_message(
-                    f'{command}#{"#".join([str(x) for x in args])}#%')
-            else:
-                self.send_raw_message(f'{command}#%')
+            if self.is_personalized(command, args):
+                for evi_num in range(len(self.evi_list)):
+                    if self.evi_list[evi_num] == args[11]:
+                        lst = list(args)
+                        lst[11] = evi_num
+                        args = tuple(lst)
+                        break
+            self.send_packet(
+                self.encode_command(command, *args),
+                command in self.server.config['send_queue']['drop_commands'])
 
         def send_ooc(self, msg):
             """
@@ -150,13 +268,19 @@ class ClientManager:
             name_ws = name.replace(' ', '')
             if not name_ws or name_ws.isdigit():
                 return False
-            for client in self.server.client_manager.clients:
+            for client in self.server.client_manager.clients_by_name.get(
+                    name.lower(), ()):
                 if client.name == name:
                     return False
             return True
 
         def disconnect(self):
-            """Disconnect the client gracefully."""
+            """
+            Disconnect the client gracefully. Everything queued for it,
+            such as a kick or ban message, is still sent before the
+            connection closes, even if the client is congested.
+            """
+            self.flush(final=True)
             self.transport.close()
 
         def change_character(self, char_id, force=False):
@@ -185,8 +309,7 @@ class ClientManager:
             self.char_id = char_id
             self.pos = ''
             self.send_command('PV', self.id, 'CID', self.char_id)
-            self.area.send_command('CharsCheck',
-                                   *self.get_available_char_list())
+            self.area.send_chars_check()
 
             new_char = self.char_name
             database.log_room('char.change', self, self.area,
@@ -291,8 +414,7 @@ class ClientManager:
 
             self.send_ooc(
                 f'Changed area to {area.name} [{self.area.status}].')
-            self.area.send_command('CharsCheck',
-                                   *self.get_available_char_list())
+            self.area.send_chars_check()
             self.send_command('HP', 1, self.area.hp_def)
             self.send_command('HP', 2, self.area.hp_pro)
             self.send_command('BN', self.area.background)
@@ -420,17 +542,14 @@ class ClientManager:
             This unconditionally causes the client to show the character
             selection screen, even if the client has already joined.
             """
-            self.send_command('CharsCheck', *self.get_available_char_list())
+            self.send_chars_check()
             self.send_command('HP', 1, self.area.hp_def)
             self.send_command('HP', 2, self.area.hp_pro)
             self.send_command('BN', self.area.background)
             self.send_command('LE', *self.area.get_evidence_list(self))
             self.send_command('MM', 1)
 
-            self.server.area_manager.send_arup_players()
-            self.server.area_manager.send_arup_status()
-            self.server.area_manager.send_arup_cms()
-            self.server.area_manager.send_arup_lock()
+            self.server.area_manager.send_arup_to(self)
 
             self.send_command('DONE')
 
@@ -442,17 +561,22 @@ class ClientManager:
         def get_available_char_list(self):
             """Get a list of character IDs that the client can select."""
             if len(self.charcurse) > 0:
-                avail_char_ids = set(range(len(
-                    self.server.char_list))) and set(self.charcurse)
+                # Charcursed clients may only pick from their curse,
+                # whether or not the characters are taken.
+                char_list = [-1] * len(self.server.char_list)
+                for x in self.charcurse:
+                    if 0 <= x < len(char_list):
+                        char_list[x] = 0
+                return char_list
+            return list(self.area.get_char_status())
+
+        def send_chars_check(self):
+            """Send the client which characters it can select."""
+            if len(self.charcurse) > 0:
+                self.send_command('CharsCheck',
+                                  *self.get_available_char_list())
             else:
-                avail_char_ids = set(range(len(self.server.char_list))) - {
-                    x.char_id
-                    for x in self.area.clients
-                }
-            char_list = [-1] * len(self.server.char_list)
-            for x in avail_char_ids:
-                char_list[x] = 0
-            return char_list
+                self.send_packet(self.area.get_chars_check_packet())
 
         def auth_mod(self, password):
             """
@@ -485,6 +609,41 @@ class ClientManager:
             """Get an anonymized version of the IP address."""
             return self.ipid
 
+        @property
+        def name(self):
+            """Get the OOC name of the client."""
+            return self._name
+
+        @name.setter
+        def name(self, name):
+            with self.server.client_manager.reindexing(self):
+                self._name = name
+
+        @property
+        def hdid(self):
+            """Get the hardware ID that the client sent."""
+            return self._hdid
+
+        @hdid.setter
+        def hdid(self, hdid):
+            with self.server.client_manager.reindexing(self):
+                self._hdid = hdid
+
+        @property
+        def char_id(self):
+            """Get the ID of the client's character, or -1 if none."""
+            return self._char_id
+
+        @char_id.setter
+        def char_id(self, char_id):
+            in_area = self in self.area.clients
+            with self.server.client_manager.reindexing(self):
+                if in_area:
+                    self.area.release_char(self, self._char_id)
+                self._char_id = char_id
+                if in_area:
+                    self.area.take_char(self, char_id)
+
         @property
         def char_name(self):
             """Get the name of the character that the client is using."""
@@ -537,13 +696,111 @@ class ClientManager:
         self.server = server
         self.cur_id = [i for i in range(self.server.config['playerlimit'])]
 
+        # Secondary indexes over the connected clients, so that targeting
+        # a player does not need to walk every client on the server.
+        # Names are keyed in lowercase and map to sets of clients, since
+        # several clients may share a name, an IPID or an HDID.
+        self.clients_by_id = {}
+        self.clients_by_ipid = {}
+        self.clients_by_hdid = {}
+        self.clients_by_name = {}
+        self.clients_by_char_name = {}
+
+        # Number of connected clients per IPID, which is what the
+        # multiclient limit is checked against.
+        self.ipid_connections = {}
+
+    @staticmethod
+    def _index_add(index, key, client):
+        if key is not None and key != '':
+            index.setdefault(key, set()).add(client)
+
+    @staticmethod
+    def _index_remove(index, key, client):
+        clients = index.get(key)
+        if clients is not None:
+            clients.discard(client)
+            if not clients:
+                del index[key]
+
+    def _index_keys(self, client):
+        char_name = client.char_name
+        return ((self.clients_by_ipid, client.ipid),
+                (self.clients_by_hdid, client.hdid),
+                (self.clients_by_name, client.name.lower()),
+                (self.clients_by_char_name,
+                 char_name.lower() if char_name is not None else None))
+
+    def index_client(self, client):
+        """
+        Add a client to the lookup indexes under its current IDs and names.
+        :param client: client to add
+        """
+        self.clients_by_id[client.id] = client
+        for index, key in self._index_keys(client):
+            self._index_add(index, key, client)
+
+    def unindex_client(self, client):
+        """
+        Remove a client from the lookup indexes.
+        :param client: client to remove
+        """
+        if self.clients_by_id.get(client.id) is client:
+            del self.clients_by_id[client.id]
+        for index, key in self._index_keys(client):
+            self._index_remove(index, key, client)
+
+    @contextmanager
+    def reindexing(self, client):
+        """
+        Keep the lookup indexes in sync while an indexed attribute of a
+        client changes. Clients that are not connected yet are ignored.
+        :param client: client being changed
+        """
+        indexed = self.clients_by_id.get(client.id) is client
+        if indexed:
+            self.unindex_client(client)
+        try:
+            yield
+        finally:
+            if indexed:
+                self.index_client(client)
+
+    def reindex_char_names(self):
+        """Rebuild the character name index after the character list changed."""
+        self.clients_by_char_name = {}
+        for client in self.clients:
+            char_name = client.char_name
+            if char_name is not None:
+                self._index_add(self.clients_by_char_name, char_name.lower(),
+                                client)
+
+    def broadcast_command(self, clients, command, *args):
+        """
+        Send an AO-compatible command to several clients at once.
+        The packet is serialized a single time and the same buffer is
+        written to every recipient, unless its contents differ per client.
+        :param clients: iterable of recipients
+        :param command: command name
+        :param *args: list of arguments
+        """
+        if self.Client.is_personalized(command, args):
+            for c in clients:
+                c.send_command(command, *args)
+            return
+        packet = self.Client.encode_command(command, *args)
+        droppable = command in self.server.config['send_queue']['drop_commands']
+        for c in clients:
+            c.send_packet(packet, droppable)
+
     def new_client_preauth(self, client):
+        """
+        Check whether a newly connected client is within the multiclient
+        limit of its IPID.
+        :param client: client that was just created
+        """
         maxclients = self.server.config['multiclient_limit']
-        for c in self.server.client_manager.clients:
-            if c.ipid == client.ipid:
-                if c.clientscon > maxclients:
-                    return False
-        return True
+        return self.ipid_connections.get(client.ipid, 0) <= maxclients
 
     def new_client(self, transport):
         """
@@ -562,10 +819,9 @@ class ClientManager:
             self.server, transport, user_id,
             database.ipid(peername))
         self.clients.add(c)
-        temp_ipid = c.ipid
-        for client in self.server.client_manager.clients:
-            if client.ipid == temp_ipid:
-                client.clientscon += 1
+        self.index_client(c)
+        self.ipid_connections[c.ipid] = \
+            self.ipid_connections.get(c.ipid, 0) + 1
         return c
 
     def remove_client(self, client):
@@ -578,15 +834,17 @@ class ClientManager:
         for a in self.server.area_manager.areas:
             if client in a.owners:
                 a.owners.remove(client)
-                client.server.area_manager.send_arup_cms()
+                client.server.area_manager.send_arup_cms(a)
                 if len(a.owners) == 0:
                     if a.is_locked != a.Locked.FREE:
                         a.unlock()
         heappush(self.cur_id, client.id)
-        temp_ipid = client.ipid
-        for c in self.server.client_manager.clients:
-            if c.ipid == temp_ipid:
-                c.clientscon -= 1
+        count = self.ipid_connections.get(client.ipid, 0) - 1
+        if count > 0:
+            self.ipid_connections[client.ipid] = count
+        else:
+            self.ipid_connections.pop(client.ipid, None)
+        self.unindex_client(client)
         self.clients.remove(client)
 
     def get_targets(self, client, key, value, local=False, single=False):
@@ -595,43 +853,50 @@ class ClientManager:
         Possible keys: player ID, OOC name, character name, HDID, IPID,
         IP address (same as IPID)
 
+        Names match if they are a prefix of `value`, so that the rest of
+        a command's arguments can follow the name.
+
         :param client: client
         :param key: the type of identifier that `value` represents
         :param value: data identifying a client
         :param local: search in current area only (Default value = False)
         :param single: search only a single user (Default value = False)
         """
-        areas = None
-        if local:
-            areas = [client.area]
-        else:
-            areas = client.server.area_manager.areas
-        targets = []
         if key == TargetType.ALL:
-            for nkey in range(6):
-                targets += self.get_targets(client, nkey, value, local)
-        for area in areas:
-            for client in area.clients:
-                if key == TargetType.IP:
-                    if value.lower().startswith(client.ip.lower()):
-                        targets.append(client)
-                elif key == TargetType.OOC_NAME:
-                    if value.lower().startswith(
-                            client.name.lower()) and client.name:
-                        targets.append(client)
-                elif key == TargetType.CHAR_NAME:
-                    if value.lower().startswith(
-                            client.char_name.lower()):
-                        targets.append(client)
-                elif key == TargetType.ID:
-                    if client.id == value:
-                        targets.append(client)
-                elif key == TargetType.IPID:
-                    if client.ipid == value:
-                        targets.append(client)
-                elif key == TargetType.AFK:
-                    if client in area.afkers:
-                        targets.append(client)
+            targets = []
+            for nkey in (TargetType.ID, TargetType.IPID, TargetType.HDID,
+                         TargetType.OOC_NAME, TargetType.CHAR_NAME):
+                targets += [c for c in self.get_targets(client, nkey, value,
+                                                        local)
+                            if c not in targets]
+            return targets
+        if key == TargetType.AFK:
+            if local:
+                return list(client.area.afkers)
+            return [c for area in self.server.area_manager.areas
+                    for c in area.afkers]
+
+        if key == TargetType.ID:
+            target = self.clients_by_id.get(value)
+            targets = [target] if target is not None else []
+        elif key in (TargetType.IP, TargetType.IPID):
+            targets = list(self.clients_by_ipid.get(value, ()))
+        elif key == TargetType.HDID:
+            targets = list(self.clients_by_hdid.get(value, ()))
+        elif key in (TargetType.OOC_NAME, TargetType.CHAR_NAME):
+            index = self.clients_by_name if key == TargetType.OOC_NAME \
+                else self.clients_by_char_name
+            # Longest names first, so that "/pm Phoenix Wright hi" picks
+            # Phoenix Wright over Phoenix.
+            value = value.lower()
+            targets = []
+            for end in range(len(value), 0, -1):
+                targets += index.get(value[:end], ())
+        else:
+            targets = []
+
+        if local:
+            targets = [c for c in targets if c.area == client.area]
         return targets
 
     def get_muted_clients(self):
@@ -70,7 +70,7 @@ def mod_only(area_owners=False):
         def wrapper_mod_only(client, arg, *args, **kwargs):
             if not client.is_mod and (not area_owners or client not in client.area.owners):
                 raise ClientError('You must be authorized to do that.')
-            func(client, arg, *args, **kwargs)
+            return func(client, arg, *args, **kwargs)
         return wrapper_mod_only
     return decorator
 
@@ -1,4 +1,5 @@
 import shlex
+import time
 
 import arrow
 import pytimeparse
@@ -26,7 +27,12 @@ __all__ = [
     'ooc_cmd_ooc_mute',
     'ooc_cmd_ooc_unmute',
     'ooc_cmd_bans',
-    'ooc_cmd_baninfo'
+    'ooc_cmd_baninfo',
+    'ooc_cmd_lagging',
+    'ooc_cmd_checkrange',
+    'ooc_cmd_logstats',
+    'ooc_cmd_logsearch',
+    'ooc_cmd_connections'
 ]
 
 
@@ -114,7 +120,7 @@ def ooc_cmd_ban(client, arg):
     Usage: /ban <ipid> "reason" ["<N> <minute|hour|day|week|month>(s)|perma"]
     Usage 2: /ban <ipid> <ban_id>
     """
-    kickban(client, arg, False)
+    return kickban(client, arg, False)
 
 
 def ooc_cmd_banhdid(client, arg):
@@ -123,11 +129,11 @@ def ooc_cmd_banhdid(client, arg):
     DANGER: Banning webAO users by HDID has unintended consequences.
     Usage: See /ban.
     """
-    kickban(client, arg, True)
+    return kickban(client, arg, True)
 
 
 @mod_only()
-def kickban(client, arg, ban_hdid):
+async def kickban(client, arg, ban_hdid):
     args = shlex.split(arg)
     if len(args) < 2:
         raise ArgumentError('Not enough arguments.')
@@ -160,8 +166,9 @@ def kickban(client, arg, ban_hdid):
     except ValueError:
         raise ClientError(f'{raw_ipid} does not look like a valid IPID.')
 
-    ban_id = database.ban(ipid, reason, ban_type='ipid', banned_by=client,
-        ban_id=ban_id, unban_date=unban_date)
+    ban_id = await database.aio.ban(ipid, reason, ban_type='ipid',
+                                    banned_by=client, ban_id=ban_id,
+                                    unban_date=unban_date)
 
     if ipid != None:
         targets = client.server.client_manager.get_targets(
@@ -169,7 +176,8 @@ def kickban(client, arg, ban_hdid):
         if targets:
             for c in targets:
                 if ban_hdid:
-                    database.ban(c.hdid, reason, ban_type='hdid', ban_id=ban_id)
+                    await database.aio.ban(c.hdid, reason, ban_type='hdid',
+                                           ban_id=ban_id)
                 c.send_command('KB', reason)
                 c.disconnect()
                 database.log_misc('ban', client, target=c, data={'reason': reason})
@@ -366,26 +374,33 @@ def ooc_cmd_ooc_unmute(client, arg):
         len(targets)))
 
 @mod_only()
-def ooc_cmd_bans(client, _arg):
+async def ooc_cmd_bans(client, _arg):
     """
     Get the 5 most recent bans.
     Usage: /bans
     """
+    def lookup():
+        return [(ban, ban.banned_by_name) for ban in database.recent_bans()]
+
     msg = 'Last 5 bans:\n'
-    for ban in database.recent_bans():
+    for ban, banned_by_name in await database.aio.run(lookup):
         time = arrow.get(ban.ban_date).humanize()
-        msg += f'{time}: {ban.banned_by_name} ({ban.banned_by}) issued ban ' \
+        msg += f'{time}: {banned_by_name} ({ban.banned_by}) issued ban ' \
                f'{ban.ban_id} (\'{ban.reason}\')\n'
     client.send_ooc(msg)
 
 @mod_only()
-def ooc_cmd_baninfo(client, arg):
+async def ooc_cmd_baninfo(client, arg):
     """
     Get information about a ban.
-    Usage: /baninfo <id> ['ban_id'|'ipid'|'hdid']
-    By default, id identifies a ban_id.
+    Usage: /baninfo <id> ['ban_id'|'ipid'|'hdid'] ['archive']
+    By default, id identifies a ban_id. With 'archive', archived logs
+    are also searched for the name of whoever issued the ban.
     """
     args = arg.split(' ')
+    search_archives = len(args) > 1 and args[-1] == 'archive'
+    if search_archives:
+        args.pop()
     if len(arg) == 0:
         raise ArgumentError('You must specify an ID.')
     elif len(args) == 1:
@@ -396,15 +411,23 @@ def ooc_cmd_baninfo(client, arg):
     if lookup_type not in ('ban_id', 'ipid', 'hdid'):
         raise ArgumentError('Incorrect lookup type.')
 
-    ban = database.find_ban(**{lookup_type: args[0]})
-    if ban is None:
+    def lookup():
+        ban = database.find_ban(**{lookup_type: args[0]})
+        if ban is None:
+            return None
+        return ban, ban.ipids, ban.hdids, database.last_known_name(
+            ban.banned_by, search_archives=search_archives)
+
+    info = await database.aio.run(lookup)
+    if info is None:
         client.send_ooc('No ban found for this ID.')
     else:
+        ban, ipids, hdids, banned_by_name = info
         msg = f'Ban ID: {ban.ban_id}\n'
-        msg += 'Affected IPIDs: ' + ', '.join([str(ipid) for ipid in ban.ipids]) + '\n'
-        msg += 'Affected HDIDs: ' + ', '.join(ban.hdids) + '\n'
+        msg += 'Affected IPIDs: ' + ', '.join([str(ipid) for ipid in ipids]) + '\n'
+        msg += 'Affected HDIDs: ' + ', '.join(hdids) + '\n'
         msg += f'Reason: "{ban.reason}"\n'
-        msg += f'Banned by: {ban.banned_by_name} ({ban.banned_by})\n'
+        msg += f'Banned by: {banned_by_name} ({ban.banned_by})\n'
 
         ban_date = arrow.get(ban.ban_date)
         msg += f'Banned on: {ban_date.format()} ({ban_date.humanize()})\n'
@@ -414,3 +437,148 @@ def ooc_cmd_baninfo(client, arg):
         else:
             msg += 'Unban date: N/A'
         client.send_ooc(msg)
+
+
+@mod_only()
+def ooc_cmd_lagging(client, arg):
+    """
+    Show clients that have outgoing data waiting to be sent.
+    Usage: /lagging
+    """
+    if len(arg) != 0:
+        raise ArgumentError("This command doesn't take any arguments")
+    lagging = [c for c in client.server.client_manager.clients
+               if c != client and (c.send_queue_size > 0 or c.dropped_packets > 0)]
+    if not lagging:
+        client.send_ooc('No clients have data waiting to be sent.')
+        return
+    msg = 'Outgoing queues:'
+    for c in sorted(lagging, key=lambda c: c.send_queue_size, reverse=True):
+        msg += f'\n[{c.id}] {c.char_name} ({c.ipid}): {c.send_queue_size} ' \
+               f'bytes queued, {c.dropped_packets} packets dropped'
+        if c.congested_since is not None:
+            msg += f' [congested for {int(time.time() - c.congested_since)}s]'
+    client.send_ooc(msg)
+
+
+@mod_only()
+def ooc_cmd_checkrange(client, arg):
+    """
+    Check an IP address against the IP range ban list.
+    Usage: /checkrange <ip>
+    """
+    if len(arg) == 0:
+        raise ArgumentError('You must specify an IP address.')
+    asn = client.server.get_asn(arg)
+    line = client.server.iprange_bans.find(arg, asn)
+    if line is None:
+        client.send_ooc(f'{arg} (ASN: {asn}) is not covered by a range ban.')
+    else:
+        client.send_ooc(f'{arg} (ASN: {asn}) is banned by line {line} '
+                        'of iprange_ban.txt.')
+
+
+@mod_only()
+def ooc_cmd_logstats(client, arg):
+    """
+    Show how far behind the database log writer is.
+    Usage: /logstats
+    """
+    if len(arg) != 0:
+        raise ArgumentError("This command doesn't take any arguments")
+    stats = database.write_stats()
+    client.send_ooc(f'Log writer: {stats["queued"]} rows queued, '
+                    f'{stats["written"]} written, {stats["dropped"]} dropped, '
+                    f'{stats["failed"]} failed. Last batch was committed '
+                    f'{stats["lag"] * 1000:.0f} ms after its first event.')
+
+
+@mod_only()
+async def ooc_cmd_logsearch(client, arg):
+    """
+    Search IC and OOC logs for messages containing all of the given words.
+    Filters can be given anywhere among the words: area:<abbreviation>,
+    ipid:<ipid>, since:<time ago> and until:<time ago>.
+    Only the live database is searched: events moved to the archive
+    by log_retention are not found.
+    Usage: /logsearch <words...> [area:<abbr>] [ipid:<ipid>] [since:<time>] [until:<time>] [page:<n>]
+    Example: /logsearch objection area:CR1 since:2d
+    """
+    page_size = 10
+    words = []
+    filters = {}
+    page = 1
+    for word in arg.split():
+        key, sep, value = word.partition(':')
+        if not sep or key not in ('area', 'ipid', 'since', 'until', 'page'):
+            words.append(word)
+        elif key == 'area':
+            filters['area'] = value
+        elif key in ('ipid', 'page'):
+            try:
+                number = int(value)
+            except ValueError:
+                raise ArgumentError(f'{key} must be a number.')
+            if key == 'ipid':
+                filters['ipid'] = number
+            else:
+                page = max(number, 1)
+        else:
+            duration = pytimeparse.parse(value)
+            if duration is None:
+                raise ArgumentError(f'Invalid time for {key}: {value}')
+            filters[key] = arrow.utcnow().shift(seconds=-duration).datetime
+    if not words:
+        raise ArgumentError('You must specify something to search for.')
+
+    # Ask for one more result than shown to know if there is another page.
+    rows = await database.aio.search_logs(' '.join(words),
+                                          count=page_size + 1,
+                                          offset=(page - 1) * page_size,
+                                          **filters)
+    if not rows:
+        client.send_ooc('No matching messages found.')
+        return
+    msg = f'Search results (page {page}):'
+    for row in rows[:page_size]:
+        kind = '' if row['kind'] == 'ic' else f' [{row["kind"]}]'
+        msg += f'\n[{row["event_time"]}] [{row["room_name"]}] ' \
+               f'{row["char_name"]}/{row["name"]} ({row["ipid"]}){kind}: ' \
+               f'{row["message"]}'
+    if len(rows) > page_size:
+        msg += f'\nMore results: add page:{page + 1} to the search.'
+    client.send_ooc(msg)
+
+
+@mod_only()
+def ooc_cmd_connections(client, arg):
+    """
+    Show how many clients are connected from each IPID.
+    Without an IPID, lists the IPIDs with more than one client.
+    Usage: /connections [ipid]
+    """
+    manager = client.server.client_manager
+    limit = client.server.config['multiclient_limit']
+    if len(arg) != 0:
+        try:
+            ipid = int(arg)
+        except ValueError:
+            raise ArgumentError(f'{arg} does not look like a valid IPID.')
+        count = manager.ipid_connections.get(ipid, 0)
+        msg = f'IPID {ipid} has {count}/{limit} clients connected.'
+        for c in sorted(manager.clients_by_ipid.get(ipid, ()),
+                        key=lambda c: c.id):
+            msg += f'\n[{c.id}] {c.char_name} in {c.area.abbreviation}'
+        client.send_ooc(msg)
+        return
+    multi = [(ipid, count) for ipid, count in manager.ipid_connections.items()
+             if count > 1]
+    if not multi:
+        client.send_ooc(f'{len(manager.ipid_connections)} IPIDs connected, '
+                        'none with more than one client.')
+        return
+    msg = f'{len(manager.ipid_connections)} IPIDs connected. ' \
+          f'Multiclients (limit {limit}):'
+    for ipid, count in sorted(multi, key=lambda m: m[1], reverse=True):
+        msg += f'\n{ipid}: {count} clients'
+    client.send_ooc(msg)
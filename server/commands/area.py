@@ -126,21 +126,15 @@ def ooc_cmd_status(client, arg):
 def ooc_cmd_area(client, arg):
     """
     List areas, or go to another area/room.
-    Usage: /area [id]
+    The area can be given by its ID, abbreviation or name.
+    The whole argument is used, since area names may contain spaces.
+    Usage: /area [id|abbreviation|name]
     """
-    args = arg.split()
-    if len(args) == 0:
+    if len(arg.strip()) == 0:
         client.send_area_list()
-    elif len(args) == 1:
-        try:
-            area = client.server.area_manager.get_area_by_id(int(args[0]))
-            client.change_area(area)
-        except ValueError:
-            raise ArgumentError('Area ID must be a number.')
-        except (AreaError, ClientError):
-            raise
-    else:
-        raise ArgumentError('Too many arguments. Use /area <id>.')
+        return
+    area = client.server.area_manager.find_area(arg.strip())
+    client.change_area(area)
 
 
 def ooc_cmd_getarea(client, arg):
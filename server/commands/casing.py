@@ -104,7 +104,7 @@ def ooc_cmd_cm(client, arg):
         client.area.owners.append(client)
         if client.area.evidence_mod == 'HiddenCM':
             client.area.broadcast_evidence_list()
-        client.server.area_manager.send_arup_cms()
+        client.server.area_manager.send_arup_cms(client.area)
         client.area.broadcast_ooc('{} [{}] is CM in this area now.'.format(
             client.char_name, client.id))
         database.log_room('cm.add', client, client.area, target=client, message='self-added')
@@ -128,7 +128,7 @@ def ooc_cmd_cm(client, arg):
                     client.area.owners.append(c)
                     if client.area.evidence_mod == 'HiddenCM':
                         client.area.broadcast_evidence_list()
-                    client.server.area_manager.send_arup_cms()
+                    client.server.area_manager.send_arup_cms(client.area)
                     client.area.broadcast_ooc(
                         '{} [{}] is CM in this area now.'.format(
                             c.char_name, c.id))
@@ -157,7 +157,7 @@ def ooc_cmd_uncm(client, arg):
                 client, TargetType.ID, id, False)[0]
             if c in client.area.owners:
                 client.area.owners.remove(c)
-                client.server.area_manager.send_arup_cms()
+                client.server.area_manager.send_arup_cms(client.area)
                 client.area.broadcast_ooc(
                     '{} [{}] is no longer CM in this area.'.format(
                         c.char_name, c.id))
@@ -0,0 +1,66 @@
+import asyncio
+import os
+import shutil
+
+import pytest
+
+from server import database
+from server.tsuserver import TsuServer3
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class FakeTransport:
+    """Transport that keeps everything written to it."""
+
+    def __init__(self, ip):
+        self.ip = ip
+        self.written = []
+        self.closed = False
+
+    def get_extra_info(self, name):
+        if name == 'peername':
+            return (self.ip, 0)
+        return None
+
+    def write(self, data):
+        self.written.append(data)
+
+    def get_write_buffer_size(self):
+        return 0
+
+    def is_closing(self):
+        return self.closed
+
+    def close(self):
+        self.closed = True
+
+    abort = close
+
+
+@pytest.fixture
+def tsuserver(tmp_path, monkeypatch):
+    """A server running from the sample config, in a scratch directory."""
+    shutil.copytree(os.path.join(ROOT, 'config_sample'), tmp_path / 'config')
+    for directory in ('migrations', 'characters'):
+        os.symlink(os.path.join(ROOT, directory), tmp_path / directory)
+    os.mkdir(tmp_path / 'storage')
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr('server.logger.setup_logger', lambda debug: None)
+    monkeypatch.setattr(database, '_database_singleton', None)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    server = TsuServer3()
+    yield server
+    database.close()
+    loop.close()
+    asyncio.set_event_loop(None)
+
+
+@pytest.fixture
+def connect(tsuserver):
+    """Connect a new client to the server from the given address."""
+    def connect(ip='127.0.0.1'):
+        return tsuserver.new_client(FakeTransport(ip))
+    return connect
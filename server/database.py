@@ -1,7 +1,13 @@
 import os
 
 import asyncio
+import atexit
+import functools
+import heapq
+import queue
 import sqlite3
+import threading
+import time
 import json
 
 import arrow
@@ -10,19 +16,87 @@ import logging
 logger = logging.getLogger('debug')
 event_logger = logging.getLogger('events')
 
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass, field
 from datetime import datetime
 from functools import reduce
+from glob import glob
+from itertools import groupby, takewhile
 from textwrap import dedent
 
-from .exceptions import ServerError
+from .exceptions import ArgumentError, ServerError
 
 
 DB_FILE = 'storage/db.sqlite3'
+ARCHIVE_DIR = 'storage/archive'
+EVENT_TABLES = ('ic_events', 'room_events', 'connect_events', 'misc_events')
 _database_singleton = None
 
+# Settings applied to every connection, unless overridden in config.yaml.
+DEFAULT_PROFILE = {
+    'journal_mode': 'wal',
+    'synchronous': 'normal',
+    'cache_size': -16000,
+    'mmap_size': 268435456,
+    'temp_store': 'memory'
+}
+# Allowed values of the pragmas that take a keyword. For `synchronous`
+# and `temp_store`, SQLite reports the index into this list.
+PRAGMA_KEYWORDS = {
+    'journal_mode': ['delete', 'truncate', 'persist', 'memory', 'wal', 'off'],
+    'synchronous': ['off', 'normal', 'full', 'extra'],
+    'temp_store': ['default', 'file', 'memory']
+}
+
+# Statements run for every connection or logged event. They are dedented
+# once here, and since their text never changes, sqlite3 keeps reusing
+# the prepared statement from its cache.
+INSERT_IPID = dedent('''
+    INSERT OR IGNORE INTO ipids(ip_address) VALUES (?)
+    ''')
+INSERT_HDID = dedent('''
+    INSERT OR IGNORE INTO hdids(hdid, ipid) VALUES (?, ?)
+    ''')
+INSERT_IC_EVENT = dedent('''
+    INSERT INTO ic_events(event_time, ipid, room_name, char_name,
+        ic_name, message) VALUES (?, ?, ?, ?, ?, ?)
+    ''')
+INSERT_ROOM_EVENT = dedent('''
+    INSERT INTO room_events(event_time, ipid, room_name, char_name,
+        ooc_name, event_subtype, message, target_ipid)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    ''')
+INSERT_CONNECT_EVENT = dedent('''
+    INSERT INTO connect_events(event_time, ipid, hdid, failed)
+    VALUES (?, ?, ?, ?)
+    ''')
+INSERT_MISC_EVENT = dedent('''
+    INSERT INTO misc_events(event_time, ipid, target_ipid,
+        event_subtype, event_data) VALUES (?, ?, ?, ?, ?)
+    ''')
+
+
+def setup(profile=None):
+    """
+    Open the database with the given storage profile. If this is not
+    called, the database is opened with the default profile the first
+    time it is used. A database that is already open is closed first,
+    so that its queued writes are committed and its threads stopped.
+    :param profile: dict of SQLite settings, see DEFAULT_PROFILE
+    """
+    global _database_singleton
+    if _database_singleton is not None:
+        _database_singleton.close()
+        _database_singleton = None
+    _database_singleton = Database(profile)
+
+
 def __getattr__(name):
     global _database_singleton
+    # Imports and introspection probe for attributes like __path__,
+    # which should not open the database.
+    if name.startswith('__'):
+        raise AttributeError(name)
     if _database_singleton is None:
         _database_singleton = Database()
     return getattr(_database_singleton, name)
@@ -34,15 +108,91 @@ class Database:
     information about the server, such as users, bans, and logs.
     """
 
-    def __init__(self):
+    def __init__(self, profile=None):
         new = not os.path.exists('storage/db.sqlite3')
-        self.db = sqlite3.connect(DB_FILE)
-        self.db.execute('PRAGMA foreign_keys = ON')
-        self.db.row_factory = sqlite3.Row
+        self.profile = dict(DEFAULT_PROFILE)
+        if profile is not None:
+            self.profile.update(profile)
+        self.local = threading.local()
+        self.report_profile()
         if new:
             self.migrate_json_to_v1()
         self.migrate()
 
+        self.ipids = {}
+        self.load_ipids()
+
+        self.subtype_atoms = {'room': {}, 'misc': {}}
+        self.load_subtype_atoms()
+
+        self.ip_bans = {}
+        self.hdid_bans = {}
+        self.load_bans()
+
+        self.unban_heap = []
+        self.unban_dates = {}
+        self.unban_timer = None
+
+        self.write_interval = 0.1
+        self.write_batch_size = 500
+        self.max_queued_writes = 50000
+        self.writes = queue.Queue()
+        self.written_rows = 0
+        self.dropped_rows = 0
+        self.failed_rows = 0
+        self.write_lag = 0.0
+        self.writer = threading.Thread(target=self._write_behind,
+                                       name='db-writer', daemon=True)
+        self.aio = AsyncDatabase(self)
+        self.writer.start()
+        # The writer is a daemon thread, so commit what is left in the
+        # queue if the interpreter exits without `close` being called.
+        atexit.register(self.close)
+
+    @property
+    def db(self):
+        """
+        The connection of the calling thread. SQLite connections cannot
+        be shared between threads, so each thread gets its own.
+        """
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = self.local.conn = sqlite3.connect(DB_FILE)
+            self.apply_profile(conn)
+            conn.execute('PRAGMA foreign_keys = ON')
+            conn.row_factory = sqlite3.Row
+        return conn
+
+    def apply_profile(self, conn):
+        """Apply the storage profile to a connection."""
+        for name, value in self.profile.items():
+            if name in ('cache_size', 'mmap_size'):
+                try:
+                    value = int(value)
+                except (TypeError, ValueError):
+                    raise ServerError(f'Database setting {name} must be a number')
+            elif name in PRAGMA_KEYWORDS:
+                # YAML reads a bare `off` as false.
+                if value is False:
+                    value = 'off'
+                value = str(value).lower()
+                if value not in PRAGMA_KEYWORDS[name]:
+                    raise ServerError(f'Database setting {name} must be one of '
+                                      f'{", ".join(PRAGMA_KEYWORDS[name])}')
+            else:
+                raise ServerError(f'Unknown database setting {name}')
+            conn.execute(f'PRAGMA {name} = {value}')
+
+    def report_profile(self):
+        """Log the settings SQLite actually ended up using."""
+        settings = []
+        for name in self.profile:
+            value = self.db.execute(f'PRAGMA {name}').fetchone()[0]
+            if name in PRAGMA_KEYWORDS and isinstance(value, int):
+                value = PRAGMA_KEYWORDS[name][value]
+            settings.append(f'{name}={value}')
+        event_logger.info(f'Database settings: {", ".join(settings)}')
+
     def migrate_json_to_v1(self):
         """Migrate to v1 of the database from JSON."""
         with self.db as conn:
@@ -119,7 +269,7 @@ class Database:
             logger.debug('Migration to v1 complete')
 
     def migrate(self):
-        for version in [2, 3]:
+        for version in [2, 3, 4, 5]:
             self.migrate_to_version(version)
 
     def migrate_to_version(self, version):
@@ -133,23 +283,155 @@ class Database:
                 conn.executescript(file.read())
         logger.debug(f'Migration to v{version} complete')
 
-    def ipid(self, ip):
-        """Get an IPID from an IP address."""
+    def load_ipids(self):
+        """Load every known IP address and its IPID into memory."""
         with self.db as conn:
-            conn.execute(dedent('''
-                INSERT OR IGNORE INTO ipids(ipid, ip_address) VALUES (NULL, ?)
-                '''), (ip, ))
-            ipid = conn.execute(dedent('''
-                SELECT ipid FROM ipids WHERE ip_address = ?
-                '''), (ip, )).fetchone()['ipid']
-            return ipid
+            for row in conn.execute('SELECT ipid, ip_address FROM ipids'):
+                self.ipids[row['ip_address']] = row['ipid']
+        logger.debug(f'Loaded {len(self.ipids)} IPIDs')
+
+    def load_bans(self):
+        """Load the banned IPIDs and HDIDs into memory."""
+        with self.db as conn:
+            for row in conn.execute('SELECT ipid, ban_id FROM ip_bans'):
+                self.ip_bans[row['ipid']] = row['ban_id']
+            for row in conn.execute('SELECT hdid, ban_id FROM hdid_bans'):
+                self.hdid_bans[row['hdid']] = row['ban_id']
+
+    def ipid(self, ip):
+        """
+        Get an IPID from an IP address.
+
+        Known addresses are looked up in memory. A new address is
+        inserted right away and its IPID read back from the database,
+        so the cached IPID always refers to a row that exists before
+        any queued write refers to it.
+        """
+        ipid = self.ipids.get(ip)
+        if ipid is None:
+            with self.db as conn:
+                conn.execute(INSERT_IPID, (ip,))
+                ipid = conn.execute(dedent('''
+                    SELECT ipid FROM ipids WHERE ip_address = ?
+                    '''), (ip,)).fetchone()['ipid']
+            self.ipids[ip] = ipid
+        return ipid
+
+    def configure_writer(self, interval_ms=100, batch_size=500,
+                         max_queued=50000):
+        """
+        Set how queued writes are committed.
+        :param interval_ms: longest time a write waits for others to be
+        committed with it
+        :param batch_size: most writes committed in one transaction
+        :param max_queued: log events are dropped past this many
+        queued writes
+        """
+        self.write_interval = interval_ms / 1000
+        self.write_batch_size = batch_size
+        self.max_queued_writes = max_queued
+
+    def _queue_write(self, sql, params, droppable=True):
+        """
+        Queue a statement for the writer thread. Writes are committed
+        in the order they were queued.
+        :param droppable: whether the write may be dropped if the queue
+        is full, which is the case for log events
+        """
+        if droppable and self.writes.qsize() >= self.max_queued_writes:
+            self.dropped_rows += 1
+            return
+        self.writes.put((sql, params, time.monotonic()))
+
+    def _write_behind(self):
+        """
+        Commit queued writes in batches until `close` is called.
+        Runs in its own thread with its own connection.
+        """
+        conn = self.db
+        running = True
+        while running:
+            batch = [self.writes.get()]
+            deadline = time.monotonic() + self.write_interval
+            while len(batch) < self.write_batch_size and batch[-1] is not None:
+                try:
+                    batch.append(self.writes.get(
+                        timeout=max(0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            if batch[-1] is None:
+                running = False
+            rows = [write for write in batch if isinstance(write, tuple)]
+            if rows:
+                self._commit_writes(conn, rows)
+            for write in batch:
+                # Wake up whoever is waiting in `flush`.
+                if isinstance(write, threading.Event):
+                    write.set()
+                self.writes.task_done()
+        conn.close()
+
+    def _commit_writes(self, conn, rows):
+        """
+        Commit a batch of writes in one transaction. If that fails, the
+        rows are retried one by one so that one bad row does not take
+        the rest of the batch down with it.
+        """
+        try:
+            with conn:
+                for sql, group in groupby(rows, key=lambda row: row[0]):
+                    conn.executemany(sql, [params for _, params, _ in group])
+            self.written_rows += len(rows)
+        except sqlite3.Error:
+            for sql, params, _ in rows:
+                try:
+                    with conn:
+                        conn.execute(sql, params)
+                    self.written_rows += 1
+                except sqlite3.Error as exc:
+                    self.failed_rows += 1
+                    logger.error(f'Could not write {params}: {exc}')
+        self.write_lag = time.monotonic() - rows[0][2]
+
+    def write_stats(self):
+        """Get statistics about the writer thread."""
+        return {
+            'queued': self.writes.qsize(),
+            'written': self.written_rows,
+            'dropped': self.dropped_rows,
+            'failed': self.failed_rows,
+            'lag': self.write_lag
+        }
+
+    def flush(self):
+        """
+        Wait until every write queued so far is committed. Writes queued
+        while waiting are not waited for, so a steady stream of log
+        events cannot hold this up.
+        """
+        if not self.writer.is_alive():
+            return
+        done = threading.Event()
+        self.writes.put(done)
+        done.wait()
+
+    def close(self):
+        """
+        Commit every queued write and stop the database threads.
+        Calling this again once the database is closed does nothing.
+        """
+        if self.unban_timer is not None:
+            self.unban_timer.cancel()
+            self.unban_timer = None
+        self.aio.close()
+        if self.writer.is_alive():
+            self.writes.put(None)
+            self.writer.join()
+        atexit.unregister(self.close)
 
     def add_hdid(self, ipid, hdid):
         """Associate an HDID with an IPID."""
-        with self.db as conn:
-            conn.execute(dedent('''
-                INSERT OR IGNORE INTO hdids(hdid, ipid) VALUES (?, ?)
-                '''), (hdid, ipid))
+        self._queue_write(INSERT_HDID, (hdid, ipid), droppable=False)
 
     def ban(self,
             target_id,
@@ -162,7 +444,40 @@ class Database:
         Ban an IPID or HDID.
         These should be used sparingly, as they can affect large swaths
         of web users if used incorrectly.
+
+        This writes to the database on the calling thread. From the
+        event loop, use `aio.ban` instead.
+        """
+        ban_id = self.insert_ban(target_id, reason, ban_type, banned_by,
+                                 unban_date, ban_id)
+        self.index_ban(target_id, ban_type, ban_id, unban_date)
+        return ban_id
+
+    def _has_queued_rows(self, conn, target_id, ban_type):
+        """
+        Check whether a ban refers to an HDID that is not in the
+        database yet, and so may still be waiting in the write queue.
+        IPIDs are written as soon as they are handed out.
         """
+        return ban_type == 'hdid' and conn.execute(
+            'SELECT 1 FROM hdids WHERE hdid = ?',
+            (target_id,)).fetchone() is None
+
+    def insert_ban(self,
+                   target_id,
+                   reason,
+                   ban_type='ipid',
+                   banned_by=None,
+                   unban_date=None,
+                   ban_id=None):
+        """
+        Write a ban to the database and return its ID, without updating
+        the in-memory ban index. This may be called from any thread.
+        """
+        # Only wait for the write queue if the HDID has only just been
+        # queued for writing.
+        if self._has_queued_rows(self.db, target_id, ban_type):
+            self.flush()
         with self.db as conn:
             if ban_id is None:
                 event_logger.info(f'{banned_by.name} ({banned_by.ipid}) ' +
@@ -188,26 +503,131 @@ class Database:
                     raise ServerError(f'Error inserting ban: {exc}')
             else:
                 raise ServerError(f'unknown ban type {ban_type}')
+        return ban_id
 
-        if unban_date is not None:
-            self._schedule_unban(ban_id)
+    def index_ban(self, target_id, ban_type, ban_id, unban_date=None):
+        """
+        Add a ban that was written with `insert_ban` to the in-memory
+        ban index and unban schedule. Must be called from the event loop.
+        """
+        if ban_type == 'ipid':
+            self.ip_bans[target_id] = ban_id
+        else:
+            self.hdid_bans[target_id] = ban_id
 
-        return ban_id
+        if unban_date is not None:
+            self._schedule_unban(ban_id, unban_date)
 
-    def last_known_name(self, ipid):
+    def last_known_name(self, ipid, search_archives=False):
         """
         Find the last known OOC name of an IPID.
+        :param search_archives: whether to also look through archived
+        events, newest first, if the main database has no name
         """
+        query = dedent('''
+            SELECT ooc_name FROM room_events
+            WHERE ipid = ? AND ooc_name IS NOT NULL AND ooc_name != ''
+            ORDER BY event_time DESC LIMIT 1
+            ''')
         with self.db as conn:
-            row = conn.execute(dedent('''
-                SELECT ooc_name FROM room_events
-                WHERE ipid = ? AND ooc_name IS NOT NULL AND ooc_name != ''
-                ORDER BY event_time DESC LIMIT 1
-                '''), (ipid,)).fetchone()
-            if row is not None:
-                return row['ooc_name']
-            else:
-                return None
+            row = conn.execute(query, (ipid,)).fetchone()
+        if row is None and search_archives:
+            for archive in self.archives():
+                try:
+                    row = archive.execute(query, (ipid,)).fetchone()
+                except sqlite3.OperationalError:
+                    # This month has no room events.
+                    continue
+                finally:
+                    archive.close()
+                if row is not None:
+                    break
+        if row is not None:
+            return row['ooc_name']
+        else:
+            return None
+
+    def archives(self):
+        """
+        Open every archive database read-only, newest month first.
+        Each connection is opened as it is reached and should be closed
+        by the caller.
+        """
+        for path in sorted(glob(os.path.join(ARCHIVE_DIR, 'events-*.sqlite3')),
+                           reverse=True):
+            conn = sqlite3.connect(f'file:{path}?mode=ro', uri=True)
+            conn.row_factory = sqlite3.Row
+            yield conn
+
+    def archive_events(self, max_age, batch_size=1000):
+        """
+        Move events older than `max_age` days into one archive database
+        per month, `batch_size` rows at a time.
+
+        This is meant to be run in a worker thread. It uses its own
+        connection, and every batch is its own short transaction, so
+        the writer thread is never held up for long. Rows are copied
+        before they are deleted, so an interrupted batch can at worst
+        leave a duplicate in the archive.
+        :returns: number of events archived
+        """
+        cutoff = arrow.utcnow().shift(days=-max_age).format('YYYY-MM-DD HH:mm:ss')
+        os.makedirs(ARCHIVE_DIR, exist_ok=True)
+        conn = sqlite3.connect(DB_FILE, isolation_level=None)
+        self.apply_profile(conn)
+        archived = 0
+        try:
+            for table in EVENT_TABLES:
+                while True:
+                    # Events are inserted in order, so the oldest ones
+                    # are always at the start of the table.
+                    rows = conn.execute(dedent(f'''
+                        SELECT rowid, event_time FROM {table}
+                        ORDER BY rowid LIMIT ?
+                        '''), (batch_size,)).fetchall()
+                    if not rows or rows[0][1] >= cutoff:
+                        break
+                    month = rows[0][1][:7]
+                    batch = list(takewhile(
+                        lambda row: row[1] < cutoff and row[1][:7] == month,
+                        rows))
+                    self._archive_batch(conn, table, month, batch[0][0],
+                                        batch[-1][0])
+                    archived += len(batch)
+        finally:
+            conn.close()
+        if archived > 0:
+            logger.debug(f'Archived {archived} events older than {cutoff}')
+        return archived
+
+    def _archive_batch(self, conn, table, month, first, last):
+        """Move the rows of `table` from `first` to `last` into an archive."""
+        path = os.path.join(ARCHIVE_DIR, f'events-{month}.sqlite3')
+        conn.execute('ATTACH DATABASE ? AS archive', (path,))
+        try:
+            conn.execute(dedent(f'''
+                CREATE TABLE IF NOT EXISTS archive.{table}
+                AS SELECT * FROM main.{table} WHERE 0
+                '''))
+            conn.execute(dedent(f'''
+                CREATE INDEX IF NOT EXISTS archive.{table}_ipid
+                ON {table}(ipid, event_time)
+                '''))
+            conn.execute('BEGIN')
+            try:
+                conn.execute(dedent(f'''
+                    INSERT INTO archive.{table}
+                    SELECT * FROM main.{table} WHERE rowid BETWEEN ? AND ?
+                    '''), (first, last))
+                conn.execute(dedent(f'''
+                    DELETE FROM main.{table} WHERE rowid BETWEEN ? AND ?
+                    '''), (first, last))
+            except sqlite3.Error:
+                conn.execute('ROLLBACK')
+                raise
+            conn.execute('COMMIT')
+        finally:
+            conn.execute('DETACH DATABASE archive')
 
     @dataclass
     class Ban:
@@ -218,8 +638,12 @@ class Database:
         reason: str
 
         def __post_init__(self):
-            self.ban_date = arrow.get(self.ban_date).datetime
-            self.unban_date = arrow.get(self.unban_date).datetime
+            # Permanent bans have no unban date, and bans migrated from
+            # JSON have no ban date.
+            if self.ban_date is not None:
+                self.ban_date = arrow.get(self.ban_date).datetime
+            if self.unban_date is not None:
+                self.unban_date = arrow.get(self.unban_date).datetime
 
         @property
         def ipids(self):
@@ -250,84 +674,136 @@ class Database:
             return _database_singleton.last_known_name(self.banned_by)
 
     def find_ban(self, ipid=None, hdid=None, ban_id=None):
-        """Check if an IPID and/or HDID are banned."""
+        """
+        Check if an IPID and/or HDID are banned.
+
+        IPIDs and HDIDs are looked up in the in-memory ban index, so
+        the database is only queried once a ban is known to exist.
+        """
+        if isinstance(ipid, str) and ipid.isdigit():
+            ipid = int(ipid)
+        if ban_id is None:
+            ban_id = self.ip_bans.get(ipid)
+        if ban_id is None:
+            ban_id = self.hdid_bans.get(hdid)
+        if ban_id is None:
+            return None
         with self.db as conn:
-            # Why is this query so complicated? The answer is that I am
-            # offloading most of the work to SQLite. This query first
-            # finds HDID or IPID bans, then looks up the associated ban
-            # information. Then it finds the last known OOC name of the
-            # player who issued that ban, purely as a convenience
-            # for later use. Use `EXPLAIN QUERY PLAN` for a breakdown.
-            #   LEFT OUTER JOIN room_events ON
-            #      room_events.ipid = banned_by AND
-            #      ooc_name IS NOT NULL
-            #   ORDER BY event_time DESC LIMIT 1
             ban = conn.execute(dedent('''
-                SELECT *
-                FROM (
-                    SELECT ban_id FROM ip_bans WHERE ipid = ?
-                    UNION SELECT ban_id FROM hdid_bans WHERE hdid = ?
-                    UNION SELECT ban_id FROM bans WHERE ban_id = ?
-                )
-                JOIN bans USING (ban_id)
-                '''), (ipid, hdid, ban_id)).fetchone()
+                SELECT * FROM bans WHERE ban_id = ?
+                '''), (ban_id,)).fetchone()
             if ban is not None:
                 return Database.Ban(**ban)
             else:
                 return None
 
     def unban(self, ban_id):
-        """Remove a ban entry."""
+        """
+        Remove a ban entry.
+        :raises: ArgumentError if the ban ID is not a number
+        """
+        try:
+            ban_id = int(ban_id)
+        except ValueError:
+            raise ArgumentError(f'{ban_id} is not a valid ban ID.')
         event_logger.info(f'Unbanning {ban_id}')
         with self.db as conn:
+            ipids = [row['ipid'] for row in conn.execute(dedent('''
+                SELECT ipid FROM ip_bans WHERE ban_id = ?
+                '''), (ban_id,))]
+            hdids = [row['hdid'] for row in conn.execute(dedent('''
+                SELECT hdid FROM hdid_bans WHERE ban_id = ?
+                '''), (ban_id,))]
             unbans = conn.execute(dedent('''
                 DELETE FROM bans WHERE ban_id = ?
                 '''), (ban_id,)).rowcount
-            return unbans > 0
+        self.unban_dates.pop(ban_id, None)
+        for ipid in ipids:
+            self.ip_bans.pop(ipid, None)
+        for hdid in hdids:
+            self.hdid_bans.pop(hdid, None)
+        return unbans > 0
 
     def schedule_unbans(self):
         """
-        Schedule unbans from the database.
+        Schedule unbans from the database. This only needs to be called
+        once, after which `ban` and `unban` keep the schedule up to date.
 
-        There is a bug in Python 3.7 and below where functions cannot be
-        scheduled with a timeout longer than one day. As a workaround,
-        schedule_unbans will only get the unbans for the next 12 hours
-        and then will have to be called again 12 hours later.
+        Unbans are kept in a heap ordered by unban date, and a single
+        timer is armed for the earliest one.
         """
-        dated_bans = []
         with self.db as conn:
             dated_bans = conn.execute(dedent('''
-                SELECT ban_id FROM bans
-                WHERE unban_date IS NOT NULL AND
-                    datetime(unban_date) < datetime(?, '+12 hours')
-                '''), (arrow.utcnow().datetime,)).fetchall()
-
-        for ban in dated_bans:
-            self._schedule_unban(ban['ban_id'])
-
-    def _schedule_unban(self, ban_id):
-        with self.db as conn:
-            ban = conn.execute(dedent('''
-                SELECT unban_date FROM bans WHERE ban_id = ?
-                '''), (ban_id,)).fetchone()
-            time_to_unban = (arrow.get(ban['unban_date']) - arrow.utcnow()).total_seconds()
+                SELECT ban_id, unban_date FROM bans
+                WHERE unban_date IS NOT NULL
+                ''')).fetchall()
+
+        self.unban_dates = {ban['ban_id']: arrow.get(ban['unban_date']).timestamp()
+                            for ban in dated_bans}
+        self.unban_heap = [(unban_date, ban_id)
+                           for ban_id, unban_date in self.unban_dates.items()]
+        heapq.heapify(self.unban_heap)
+        self._arm_unban_timer()
+
+    def _schedule_unban(self, ban_id, unban_date):
+        unban_date = arrow.get(unban_date).timestamp()
+        if self.unban_dates.get(ban_id) == unban_date:
+            return
+        self.unban_dates[ban_id] = unban_date
+        heapq.heappush(self.unban_heap, (unban_date, ban_id))
+        if self.unban_heap[0][1] == ban_id:
+            self._arm_unban_timer()
+
+    def _arm_unban_timer(self):
+        """
+        Arm the unban timer for the earliest scheduled unban.
 
-            def auto_unban():
-                self.unban(ban_id)
+        There is a bug in Python 3.7 and below where functions cannot be
+        scheduled with a timeout longer than one day. As a workaround,
+        the timer never waits longer than 12 hours, and simply re-arms
+        itself if nothing is due yet when it goes off.
+        """
+        if self.unban_timer is not None:
+            self.unban_timer.cancel()
+            self.unban_timer = None
+
+        # Drop entries for bans that were lifted or rescheduled.
+        while self.unban_heap and self.unban_dates.get(
+                self.unban_heap[0][1]) != self.unban_heap[0][0]:
+            heapq.heappop(self.unban_heap)
+        if not self.unban_heap:
+            return
+
+        time_to_unban = min(self.unban_heap[0][0] - time.time(), 12 * 3600)
+        self.unban_timer = asyncio.get_event_loop().call_later(
+            max(time_to_unban, 0), self._auto_unban)
+
+    def _auto_unban(self):
+        self.unban_timer = None
+        now = time.time()
+        while self.unban_heap and self.unban_heap[0][0] <= now:
+            unban_date, ban_id = heapq.heappop(self.unban_heap)
+            if self.unban_dates.get(ban_id) != unban_date:
+                continue
+            del self.unban_dates[ban_id]
+            if self.unban(ban_id):
                 self.log_misc('auto_unban', data={'id': ban_id})
+        self._arm_unban_timer()
 
-            asyncio.get_event_loop().call_later(time_to_unban, auto_unban)
+    @staticmethod
+    def _timestamp():
+        """
+        Get the current time in the format of CURRENT_TIMESTAMP, since
+        queued events are written some time after they happen.
+        """
+        return arrow.utcnow().format('YYYY-MM-DD HH:mm:ss')
 
     def log_ic(self, client, room, showname, message):
         """Log an IC message."""
         event_logger.info(f'[{room.abbreviation}] {showname}/{client.char_name}' +
                           f'/{client.name} ({client.ipid}): {message}')
-        with self.db as conn:
-            conn.execute(dedent('''
-                INSERT INTO ic_events(ipid, room_name, char_name, ic_name,
-                    message) VALUES (?, ?, ?, ?, ?)
-                '''), (client.ipid, room.abbreviation, client.char_name,
-                    showname, message))
+        self._queue_write(INSERT_IC_EVENT, (self._timestamp(), client.ipid, room.abbreviation,
+                client.char_name, showname, message))
 
     def log_room(self, event_subtype, client, room, message=None, target=None):
         """
@@ -344,22 +820,14 @@ class Database:
 
         event_logger.info(f'[{room.abbreviation}] {client.char_name}' +
                     f'/{client.name} ({client.ipid}): event {event_subtype} ({message})')
-        with self.db as conn:
-            conn.execute(dedent('''
-                INSERT INTO room_events(ipid, room_name, char_name, ooc_name,
-                    event_subtype, message, target_ipid)
-                VALUES (?, ?, ?, ?, ?, ?, ?)
-                '''), (ipid, room.abbreviation, char_name, ooc_name,
-                    subtype_id, message, target_ipid))
+        self._queue_write(INSERT_ROOM_EVENT, (self._timestamp(), ipid, room.abbreviation, char_name,
+                ooc_name, subtype_id, message, target_ipid))
 
     def log_connect(self, client, failed=False):
         """Log a connect attempt."""
         event_logger.info(f'{client.ipid} (HDID: {client.hdid}) ' +
                           f'{"was blocked from connecting" if failed else "connected"}.')
-        with self.db as conn:
-            conn.execute(dedent('''
-                INSERT INTO connect_events(ipid, hdid, failed) VALUES (?, ?, ?)
-                '''), (client.ipid, client.hdid, failed))
+        self._queue_write(INSERT_CONNECT_EVENT, (self._timestamp(), client.ipid, client.hdid, failed))
 
     def log_misc(self, event_subtype, client=None, target=None, data=None):
         """
@@ -372,11 +840,64 @@ class Database:
         data_json = json.dumps(data)
         event_logger.info(f'{event_subtype} ({client_ipid} onto {target_ipid}): {data}')
 
+        self._queue_write(INSERT_MISC_EVENT, (self._timestamp(), client_ipid, target_ipid, subtype_id,
+                data_json))
+
+    def search_logs(self, text, area=None, ipid=None, since=None,
+                    until=None, count=10, offset=0):
+        """
+        Search IC messages and room events, best matches first.
+        Every word in `text` has to appear in a message for it to match.
+        :param area: only match events in the area with this abbreviation
+        :param ipid: only match events by this IPID
+        :param since: only match events at or after this datetime
+        :param until: only match events before this datetime
+        :param count: number of results to return
+        :param offset: number of results to skip
+        :returns: rows with the kind of event ('ic' or its subtype),
+        event_time, ipid, room_name, char_name, name and message
+        """
+        query = ' '.join('"' + word.replace('"', '""') + '"'
+                         for word in text.split())
+        filters = ''
+        params = [query]
+        # The filters are applied to the event rows that are joined in
+        # anyway, rather than to the UNINDEXED columns of the full-text
+        # index, which would read each event row back a second time.
+        # Starting from the (ipid, event_time) indexes instead runs one
+        # full-text lookup per event, which is slower unless the IPID
+        # has next to no events.
+        if area is not None:
+            filters += ' AND e.room_name = ? COLLATE NOCASE'
+            params.append(area)
+        if ipid is not None:
+            filters += ' AND e.ipid = ?'
+            params.append(ipid)
+        if since is not None:
+            filters += ' AND e.event_time >= ?'
+            params.append(arrow.get(since).format('YYYY-MM-DD HH:mm:ss'))
+        if until is not None:
+            filters += ' AND e.event_time < ?'
+            params.append(arrow.get(until).format('YYYY-MM-DD HH:mm:ss'))
+
         with self.db as conn:
-            conn.execute(dedent('''
-                INSERT INTO misc_events(ipid, target_ipid, event_subtype,
-                    event_data) VALUES (?, ?, ?, ?)
-                '''), (client_ipid, target_ipid, subtype_id, data_json))
+            return conn.execute(dedent(f'''
+                SELECT 'ic' AS kind, e.event_time, e.ipid, e.room_name,
+                    e.char_name, e.ic_name AS name, e.message,
+                    bm25(ic_events_fts) AS rank
+                FROM ic_events_fts
+                JOIN ic_events AS e ON e.rowid = ic_events_fts.rowid
+                WHERE ic_events_fts MATCH ?{filters}
+                UNION ALL
+                SELECT t.type_name AS kind, e.event_time, e.ipid, e.room_name,
+                    e.char_name, e.ooc_name AS name, e.message,
+                    bm25(room_events_fts) AS rank
+                FROM room_events_fts
+                JOIN room_events AS e ON e.rowid = room_events_fts.rowid
+                JOIN room_event_types AS t ON t.type_id = e.event_subtype
+                WHERE room_events_fts MATCH ?{filters}
+                ORDER BY rank LIMIT ? OFFSET ?
+                '''), params + params + [count, offset]).fetchall()
 
     def recent_bans(self, count=5):
         """
@@ -391,16 +912,93 @@ class Database:
                     ORDER BY ban_date ASC
                     '''), (count,)).fetchall()]
 
+    def load_subtype_atoms(self):
+        """Load the event subtype names and their IDs into memory."""
+        with self.db as conn:
+            for event_type, atoms in self.subtype_atoms.items():
+                for row in conn.execute(
+                        f'SELECT type_id, type_name FROM {event_type}_event_types'):
+                    atoms[row['type_name']] = row['type_id']
+
     def _subtype_atom(self, event_type, event_subtype):
+        """
+        Get the ID of an event subtype. Unknown subtypes are given the
+        next free ID and queued for writing, ahead of the event that
+        refers to them.
+        """
         if event_type not in ('room', 'misc'):
             raise AssertionError()
 
-        with self.db as conn:
-            conn.execute(dedent(f'''
-                INSERT OR IGNORE INTO {event_type}_event_types(type_name)
-                VALUES (?)
-                '''), (event_subtype,))
-            return conn.execute(dedent(f'''
-                SELECT type_id FROM {event_type}_event_types
-                WHERE type_name = ?
-                '''), (event_subtype,)).fetchone()['type_id']
+        atoms = self.subtype_atoms[event_type]
+        type_id = atoms.get(event_subtype)
+        if type_id is None:
+            type_id = max(atoms.values(), default=0) + 1
+            atoms[event_subtype] = type_id
+            self._queue_write(dedent(f'''
+                INSERT OR IGNORE INTO {event_type}_event_types(type_id,
+                    type_name) VALUES (?, ?)
+                '''), (type_id, event_subtype), droppable=False)
+        return type_id
+
+
+class AsyncDatabase:
+    """
+    Runs database calls on a single thread that owns its own connection,
+    so that slow reads can be awaited without holding up the event loop:
+
+        bans = await database.aio.recent_bans()
+
+    Only the methods in `THREAD_SAFE` can be called this way. Methods
+    that change the ban index or arm timers on the event loop, such as
+    `unban` and `schedule_unbans`, must be called on the event loop
+    itself. `ban` is the exception: it writes the ban on the database
+    thread and then updates the ban index back on the event loop.
+    """
+
+    # Methods that only read, or only write to the database, and so are
+    # safe to run off the event loop.
+    THREAD_SAFE = frozenset([
+        'find_ban', 'recent_bans', 'last_known_name', 'search_logs',
+        'insert_ban', 'archive_events', 'write_stats', 'flush'
+    ])
+
+    def __init__(self, database):
+        self.database = database
+        self.executor = ThreadPoolExecutor(max_workers=1,
+                                           thread_name_prefix='db')
+
+    def run(self, func, *args, **kwargs):
+        """
+        Run a function on the database thread. This is useful to do
+        several lookups in one go, such as loading a ban together with
+        its IPIDs and HDIDs.
+        :returns: awaitable result of the function
+        """
+        return asyncio.get_event_loop().run_in_executor(
+            self.executor, functools.partial(func, *args, **kwargs))
+
+    async def ban(self,
+                  target_id,
+                  reason,
+                  ban_type='ipid',
+                  banned_by=None,
+                  unban_date=None,
+                  ban_id=None):
+        """Ban an IPID or HDID. See `Database.ban`."""
+        ban_id = await self.run(self.database.insert_ban, target_id, reason,
+                                ban_type, banned_by, unban_date, ban_id)
+        self.database.index_ban(target_id, ban_type, ban_id, unban_date)
+        return ban_id
+
+    def __getattr__(self, name):
+        if name not in self.THREAD_SAFE:
+            raise AttributeError(f'{name} cannot be called off the event loop')
+        method = getattr(self.database, name)
+
+        def call(*args, **kwargs):
+            return self.run(method, *args, **kwargs)
+        return call
+
+    def close(self):
+        """Wait for running calls to finish and stop the thread."""
+        self.executor.shutdown()
@@ -0,0 +1,163 @@
+# tsuserver3, an Attorney Online server
+#
+# Copyright (C) 2016 argoneus <argoneuscze@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import ipaddress
+
+import logging
+logger = logging.getLogger('debug')
+
+
+class IPRangeBans:
+    """
+    Holds the IP range bans: a binary prefix trie of banned networks
+    per IP version, plus a table of banned ASNs.
+
+    Each entry remembers the line of the ban list it came from, which is
+    shown to the banned client as the ban ID.
+    """
+
+    def __init__(self):
+        # Trie nodes are lists of [zero child, one child, line number].
+        self.roots = {4: [None, None, None], 6: [None, None, None]}
+        self.asns = {}
+        self.entries = 0
+
+    @classmethod
+    def load(cls, path):
+        """
+        Build the ban table from a ban list file.
+        :param path: path to the ban list
+        :raises: OSError if the file cannot be read
+        """
+        bans = cls()
+        with open(path, 'r', encoding='utf-8') as ipranges:
+            for line, entry in enumerate(ipranges.read().splitlines()):
+                bans.add_entry(entry.strip(), line)
+        return bans
+
+    def add_entry(self, entry, line):
+        """
+        Add a single line of the ban list. Accepted formats are:
+         - an ASN (e.g. `3223`)
+         - a CIDR block, IPv4 or IPv6 (e.g. `185.220.100.0/22`,
+           `2001:db8::/32`), or a single IPv6 address
+         - a dotted IPv4 prefix or address (e.g. `176.119.`, `104.244.7`
+           or `179.186.123.15`)
+        IPv4 entries without a prefix length keep the old string prefix
+        semantics: an incomplete or unterminated last octet also matches
+        every octet that starts with it, so `179.186.123.15` bans
+        179.186.123.15 and 179.186.123.150-159. A bare number is checked
+        both as an ASN and as such a prefix.
+        Empty lines and lines starting with `#` are ignored, and so are
+        lines that cannot be parsed, with a warning. IPv6 entries are not
+        text prefixes, so a partial IPv6 address needs a prefix length.
+        :param entry: text of the line
+        :param line: line number
+        """
+        if entry == '' or entry.startswith('#'):
+            return
+        if entry.isdigit():
+            self.asns.setdefault(entry, line)
+        if '/' in entry or ':' in entry:
+            try:
+                networks = [ipaddress.ip_network(entry, strict=False)]
+            except ValueError:
+                networks = []
+        else:
+            networks = self.expand_prefix(entry)
+        if entry.isdigit() and not networks:
+            self.entries += 1
+        elif not networks:
+            logger.warning(f'Ignoring line {line} of the IP range ban list, '
+                           f'which is not a valid entry: {entry}')
+        for network in networks:
+            self.add_network(network, line)
+
+    @staticmethod
+    def expand_prefix(prefix):
+        """
+        Turn a dotted IPv4 prefix into the networks it matches.
+        :param prefix: prefix such as `107.189.10.` or `177.157.15`
+        :returns: list of networks (empty if the prefix is not valid)
+        """
+        octets = prefix.split('.')
+        partial = octets.pop()
+        if not 0 < len(octets) + (partial != '') <= 4:
+            return []
+        try:
+            base = [int(octet) for octet in octets]
+        except ValueError:
+            return []
+        if any(not 0 <= octet <= 255 for octet in base):
+            return []
+        if partial == '':
+            last = [None]
+        elif partial.isdigit():
+            last = [value for value in range(256)
+                    if str(value).startswith(partial)]
+        else:
+            return []
+        networks = []
+        for value in last:
+            fixed = base + ([] if value is None else [value])
+            address = '.'.join(str(octet) for octet in fixed + [0] * (4 - len(fixed)))
+            networks.append(ipaddress.ip_network(f'{address}/{8 * len(fixed)}'))
+        return list(ipaddress.collapse_addresses(networks))
+
+    def add_network(self, network, line):
+        """
+        Add a network to the trie.
+        :param network: `ipaddress` network object
+        :param line: line number
+        """
+        node = self.roots[network.version]
+        address = int(network.network_address)
+        bits = network.max_prefixlen
+        for i in range(network.prefixlen):
+            bit = (address >> (bits - 1 - i)) & 1
+            if node[bit] is None:
+                node[bit] = [None, None, None]
+            node = node[bit]
+        if node[2] is None:
+            node[2] = line
+        self.entries += 1
+
+    def find(self, ip, asn=None):
+        """
+        Check an address against the ban table.
+        :param ip: IP address as a string
+        :param asn: ASN of the address as a string (Default value = None)
+        :returns: line number of the matching ban, or None
+        """
+        if asn is not None and asn in self.asns:
+            return self.asns[asn]
+        try:
+            address = ipaddress.ip_address(ip)
+        except ValueError:
+            return None
+        if address.version == 6 and address.ipv4_mapped is not None:
+            address = address.ipv4_mapped
+        node = self.roots[address.version]
+        value = int(address)
+        bits = address.max_prefixlen
+        for i in range(bits):
+            if node[2] is not None:
+                return node[2]
+            node = node[(value >> (bits - 1 - i)) & 1]
+            if node is None:
+                return None
+        return node[2]
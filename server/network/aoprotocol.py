@@ -24,33 +24,27 @@ import logging
 logger_debug = logging.getLogger('debug')
 logger = logging.getLogger('events')
 
-from enum import Enum
-
 import arrow
 from time import localtime, strftime
 
 from server import database
 from server.exceptions import ClientError, AreaError, ArgumentError, ServerError
 from server.fantacrypt import fanta_decrypt
+from . import packets
 from .. import commands
 
 
 class AOProtocol(asyncio.Protocol):
     """The main class that deals with the AO protocol."""
 
-    class ArgType(Enum):
-        """Represents the data type of an argument for a network command."""
-        STR = 1,
-        STR_OR_EMPTY = 2,
-        INT = 3,
-        INT_OR_STR = 3
-
     def __init__(self, server):
         super().__init__()
         self.server = server
         self.client = None
-        self.buffer = ''
+        self.buffer = bytearray()
+        self.buffer_scanned = 0
         self.ping_timeout = None
+        self.lost = False
 
     def dezalgo(self, input):
         """
@@ -78,19 +72,14 @@ class AOProtocol(asyncio.Protocol):
         :param data: bytes of data
 
         """
-        buf = data
         ipid = self.client.ipid
 
-        if buf is None:
-            buf = b''
-
-        if not isinstance(buf, str):
-            # try to decode as utf-8, ignore any erroneous characters
-            self.buffer += buf.decode('utf-8', 'ignore')
-        else:
-            self.buffer = buf
+        if data is None:
+            data = b''
+        elif isinstance(data, str):
+            data = data.encode('utf-8')
 
-        self.buffer = self.buffer.translate({ord(c): None for c in '\0'})
+        self.buffer += data.replace(b'\0', b'')
 
         if len(self.buffer) > 8192:
             self.client.disconnect()
@@ -114,11 +103,34 @@ class AOProtocol(asyncio.Protocol):
 
         :param transport: the transport object
         """
+        peername = transport.get_extra_info('peername')[0]
+        if self.server.needs_asn_lookup(peername):
+            # Hold off reading until the ASN is known, so range bans are
+            # checked before any packet from this client is handled.
+            transport.pause_reading()
+            lookup = asyncio.ensure_future(self.server.fetch_asn(peername))
+            lookup.add_done_callback(lambda _: self.admit(transport))
+            return
+        self.admit(transport)
+
+    def admit(self, transport):
+        """Let a new client in once its address can be checked for bans.
+
+        :param transport: the transport object
+        """
+        if self.lost:
+            return
         try:
             self.client = self.server.new_client(transport)
         except ClientError:
+            transport.resume_reading()
             transport.close()
             return
+        transport.resume_reading()
+
+        limits = self.server.config['send_queue']
+        transport.set_write_buffer_limits(high=limits['high_watermark'],
+                                          low=limits['low_watermark'])
 
         if not self.server.client_manager.new_client_preauth(self.client):
             self.client.send_command('BD', 'Maximum clients reached.\nDisconnect one of your clients to continue.')
@@ -140,46 +152,70 @@ class AOProtocol(asyncio.Protocol):
         :param exc: reason
 
         """
+        self.lost = True
         if self.client is not None:
             logger.debug(f'{self.client.ipid} disconnected.')
             self.server.remove_client(self.client)
         if self.ping_timeout is not None:
             self.ping_timeout.cancel()
 
+    def pause_writing(self):
+        """Called when the transport's buffer goes over the high watermark.
+
+        Outgoing packets are kept in the client's own queue until the
+        transport drains.
+
+        """
+        if self.client is not None:
+            self.client.writing_paused = True
+
+    def resume_writing(self):
+        """Called when the transport's buffer drains below the low watermark."""
+        if self.client is not None:
+            self.client.writing_paused = False
+            self.client.flush()
+
     def get_messages(self):
         """Parses out full messages from the buffer.
 
+        Only the bytes that have not been scanned yet are searched for
+        the terminator, and the consumed part of the buffer is dropped
+        once at the end. Frames are decoded straight out of the buffer;
+        since `#%` is plain ASCII, a frame always ends on a character
+        boundary and multi-byte characters split across reads are kept
+        intact until the rest of them arrives.
+
         :return: yields messages
 
         """
-        while '#%' in self.buffer:
-            spl = self.buffer.split('#%', 1)
-            self.buffer = spl[1]
-            yield spl[0]
-
-    def validate_net_cmd(self, args, *types, needs_auth=True):
-        """Makes sure the net command's arguments match expectations.
-
+        start = 0
+        try:
+            with memoryview(self.buffer) as view:
+                while True:
+                    end = self.buffer.find(b'#%',
+                                           max(start, self.buffer_scanned))
+                    if end == -1:
+                        break
+                    msg = str(view[start:end], 'utf-8', 'ignore')
+                    start = end + 2
+                    yield msg
+        finally:
+            del self.buffer[:start]
+            self.buffer_scanned = max(len(self.buffer) - 1, 0)
+
+    def decode_net_cmd(self, cmd, args):
+        """Decodes a net command's arguments according to its schema.
+
+        :param cmd: name of the net command
         :param args: actual arguments to the net command
-        :param types: what kind of data types are expected
-        :param needs_auth: whether you need to have chosen a character (Default value = True)
-        :param *types: list of types corresponding to each argument in the command
-        :returns: returns True if message was validated
-
-        """
-        if needs_auth and self.client.char_id == -1:
-            return False
-        if len(args) != len(types):
-            return False
-        for i, arg in enumerate(args):
-            if len(arg) == 0 and types[i] != self.ArgType.STR_OR_EMPTY:
-                return False
-            if types[i] == self.ArgType.INT:
-                try:
-                    args[i] = int(arg)
-                except ValueError:
-                    return False
-        return True
+        :returns: a record of the decoded arguments, or None if they do not
+        match the schema or the client needs to have chosen a character
+
+        """
+        schema = packets.SCHEMAS[cmd]
+        if schema.needs_auth and self.client.char_id == -1:
+            return None
+        return schema.decode(args)
 
     def net_cmd_hi(self, args):
         """Handshake.
@@ -189,9 +225,10 @@ class AOProtocol(asyncio.Protocol):
         :param args: a list containing all the arguments
 
         """
-        if not self.validate_net_cmd(args, self.ArgType.STR, needs_auth=False):
+        args = self.decode_net_cmd('HI', args)
+        if args is None:
             return
-        hdid = self.client.hdid = args[0]
+        hdid = self.client.hdid = args.hdid
         ipid = self.client.ipid
 
         database.add_hdid(ipid, hdid)
@@ -245,17 +282,14 @@ class AOProtocol(asyncio.Protocol):
 
         askchaa#%
         """
-        char_cnt = len(self.server.char_list)
-        evi_cnt = 0
-        music_cnt = sum([len(x) for x in self.server.music_pages_ao1])
-        self.client.send_command('SI', char_cnt, evi_cnt, music_cnt)
+        self.client.send_packet(self.server.list_sizes_packet)
 
     def net_cmd_askchar2(self, _):
         """Asks for the character list. (AO1)
 
         askchar2#%
         """
-        self.client.send_command('CI', *self.server.char_pages_ao1[0])
+        self.client.send_packet(self.server.char_page_packets_ao1[0])
 
     def net_cmd_an(self, args):
         """Asks for specific pages of the character list.
@@ -263,13 +297,14 @@ class AOProtocol(asyncio.Protocol):
 
         AN#<page:int>#%
         """
-        if not self.validate_net_cmd(args, self.ArgType.INT, needs_auth=False):
+        args = self.decode_net_cmd('AN', args)
+        if args is None:
             return
-        if len(self.server.char_pages_ao1) > args[0] >= 0:
-            self.client.send_command('CI',
-                                     *self.server.char_pages_ao1[args[0]])
+        if len(self.server.char_page_packets_ao1) > args.page >= 0:
+            self.client.send_packet(
+                self.server.char_page_packets_ao1[args.page])
         else:
-            self.client.send_command('EM', *self.server.music_pages_ao1[0])
+            self.client.send_packet(self.server.music_page_packets_ao1[0])
 
     def net_cmd_ae(self, _):
         """Asks for specific pages of the evidence list.
@@ -287,11 +322,12 @@ class AOProtocol(asyncio.Protocol):
         AM#<page:int>#%
 
         """
-        if not self.validate_net_cmd(args, self.ArgType.INT, needs_auth=False):
+        args = self.decode_net_cmd('AM', args)
+        if args is None:
             return
-        if len(self.server.music_pages_ao1) > args[0] >= 0:
-            self.client.send_command('EM',
-                                     *self.server.music_pages_ao1[args[0]])
+        if len(self.server.music_page_packets_ao1) > args.page >= 0:
+            self.client.send_packet(
+                self.server.music_page_packets_ao1[args.page])
         else:
             self.client.send_done()
             self.client.send_area_list()
@@ -304,7 +340,7 @@ class AOProtocol(asyncio.Protocol):
 
         """
 
-        self.client.send_command('SC', *self.server.char_list)
+        self.client.send_packet(self.server.char_list_packet)
 
     def net_cmd_rm(self, _):
         """Asks for the whole music list (AO2)
@@ -313,7 +349,7 @@ class AOProtocol(asyncio.Protocol):
 
         """
 
-        self.client.send_command('SM', *self.server.music_list_ao2)
+        self.client.send_packet(self.server.music_list_packet)
 
     def net_cmd_rd(self, _):
         """Asks for server metadata(charscheck, motd etc.) and a DONE#% signal(also best packet)
@@ -332,16 +368,13 @@ class AOProtocol(asyncio.Protocol):
         CC#<client_id:int>#<char_id:int>#<hdid:string>#%
 
         """
-        if not self.validate_net_cmd(args,
-                                     self.ArgType.INT,
-                                     self.ArgType.INT,
-                                     self.ArgType.STR,
-                                     needs_auth=False):
+        args = self.decode_net_cmd('CC', args)
+        if args is None:
             return
         elif not self.client.is_checked:
             return
 
-        cid = args[1]
+        cid = args.char_id
         try:
             self.client.change_character(cid)
         except ClientError:
@@ -362,36 +395,13 @@ class AOProtocol(asyncio.Protocol):
             return
 
         target_area = []
-        if self.validate_net_cmd(args, self.ArgType.STR, # msg_type
-                                 self.ArgType.STR_OR_EMPTY, self.ArgType.STR,   # pre, folder
-                                 self.ArgType.STR, self.ArgType.STR,            # anim, text
-                                 self.ArgType.STR, self.ArgType.STR,            # pos, sfx
-                                 self.ArgType.INT, self.ArgType.INT,            # anim_type, cid
-                                 self.ArgType.INT, self.ArgType.INT_OR_STR,     # sfx_delay, button
-                                 self.ArgType.INT, self.ArgType.INT,            # evidence, flip
-                                 self.ArgType.INT, self.ArgType.INT):           # ding, color
-            # Pre-2.6 validation monstrosity.
-            msg_type, pre, folder, anim, text, pos, sfx, anim_type, cid, sfx_delay, button, evidence, flip, ding, color = args
-            showname = ""
-            charid_pair = -1
-            offset_pair = 0
-            nonint_pre = 0
-        elif self.validate_net_cmd(
-                args, self.ArgType.STR, self.ArgType.STR_OR_EMPTY,              # msg_type, pre
-                self.ArgType.STR, self.ArgType.STR, self.ArgType.STR,           # folder, anim, text
-                self.ArgType.STR, self.ArgType.STR, self.ArgType.INT,           # pos, sfx, anim_type
-                self.ArgType.INT, self.ArgType.INT, self.ArgType.INT_OR_STR,    # cid, sfx_delay, button
-                self.ArgType.INT, self.ArgType.INT, self.ArgType.INT,           # evidence, flip, ding
-                self.ArgType.INT, self.ArgType.STR_OR_EMPTY, self.ArgType.INT,  # color, showname, charid_pair
-                self.ArgType.INT, self.ArgType.INT):                            # offset_pair, nonint_pre
-            # 2.6+ validation monstrosity.
-            msg_type, pre, folder, anim, text, pos, sfx, anim_type, cid, sfx_delay, button, evidence, flip, ding, color, showname, charid_pair, offset_pair, nonint_pre = args
-            if len(showname
-                   ) > 0 and not self.client.area.showname_changes_allowed:
-                self.client.send_ooc(
-                    "Showname changes are forbidden in this area!")
-                return
-        else:
+        record = self.decode_net_cmd('MS', args)
+        if record is None:
+            return
+        msg_type, pre, folder, anim, text, pos, sfx, anim_type, cid, sfx_delay, button, evidence, flip, ding, color, showname, charid_pair, offset_pair, nonint_pre = record
+        if len(showname) > 0 and not self.client.area.showname_changes_allowed:
+            self.client.send_ooc(
+                "Showname changes are forbidden in this area!")
             return
         if self.client.area.is_iniswap(self.client, pre, anim,
                 folder, sfx):
@@ -442,23 +452,11 @@ class AOProtocol(asyncio.Protocol):
                 self.client.send_ooc('You don\'t any areas!')
                 return
             text = ' '.join(part[1:])
-        if msg_type not in ('chat', '0', '1'):
-            return
-        if anim_type not in (0, 1, 2, 5, 6):
-            return
         if cid != self.client.char_id:
             return
-        if sfx_delay < 0:
-            return
         if '4' in button and "<and>" not in button:
             if not button.isdigit():
                return
-        if evidence < 0:
-            return
-        if ding not in (0, 1):
-            return
-        if color not in (0, 1, 2, 3, 4, 5, 6, 7, 8):
-            return
         if len(showname) > 15:
             self.client.send_ooc("Your IC showname is way too long!")
             return
@@ -581,7 +579,21 @@ class AOProtocol(asyncio.Protocol):
         database.log_ic(self.client, self.client.area, showname, msg)
 
         if (self.client.area.is_recording):
-            self.client.area.recorded_messages.append(args)
+            self.client.area.recorded_messages.append(record)
+
+    async def run_command(self, command):
+        """Finish running a command that is a coroutine.
+
+        :param command: coroutine returned by the command
+
+        """
+        try:
+            await command
+        except (ClientError, AreaError, ArgumentError, ServerError) as ex:
+            self.client.send_ooc(ex)
+        except Exception:
+            self.client.send_ooc('An internal error occurred. Please check the server log.')
+            logger.exception('Exception while running a command')
 
     def net_cmd_ct(self, args):
         """OOC Message
@@ -594,14 +606,16 @@ class AOProtocol(asyncio.Protocol):
         if self.client.is_ooc_muted:  # Checks to see if the client has been muted by a mod
             self.client.send_ooc('You are muted by a moderator.')
             return
-        if not self.validate_net_cmd(args, self.ArgType.STR, self.ArgType.STR):
+        args = self.decode_net_cmd('CT', args)
+        if args is None:
             return
-        if self.client.name != args[0] and self.client.fake_name != args[0]:
-            if self.client.is_valid_name(args[0]):
-                self.client.name = args[0]
-                self.client.fake_name = args[0]
+        message = args.message
+        if self.client.name != args.name and self.client.fake_name != args.name:
+            if self.client.is_valid_name(args.name):
+                self.client.name = args.name
+                self.client.fake_name = args.name
             else:
-                self.client.fake_name = args[0]
+                self.client.fake_name = args.name
         if self.client.name == '':
             self.client.send_ooc(
                 'You must insert a name with at least one letter')
@@ -620,13 +634,13 @@ class AOProtocol(asyncio.Protocol):
                     '<dollar>G') or self.client.name.startswith('<dollar>M'):
             self.client.send_ooc('That name is reserved!')
             return
-        if args[1].startswith(' /'):
+        if message.startswith(' /'):
             self.client.send_ooc(
                 'Your message was not sent for safety reasons: you left a space before that slash.'
             )
             return
-        if args[1].startswith('/'):
-            spl = args[1][1:].split(' ', 1)
+        if message.startswith('/'):
+            spl = message[1:].split(' ', 1)
             cmd = spl[0].lower()
             arg = ''
             if len(spl) == 2:
@@ -638,24 +652,27 @@ class AOProtocol(asyncio.Protocol):
                 elif not hasattr(commands, called_function):
                     self.client.send_ooc('Invalid command.')
                 else:
-                    getattr(commands, called_function)(self.client, arg)
+                    result = getattr(commands, called_function)(self.client, arg)
+                    # Commands that wait on the database are coroutines.
+                    if asyncio.iscoroutine(result):
+                        asyncio.ensure_future(self.run_command(result))
             except (ClientError, AreaError, ArgumentError, ServerError) as ex:
                 self.client.send_ooc(ex)
             except Exception as ex:
                 self.client.send_ooc('An internal error occurred. Please check the server log.')
                 logger.exception('Exception while running a command')
         else:
-            args[1] = self.dezalgo(args[1])
+            message = self.dezalgo(message)
             if self.client.shaken:
-                args[1] = self.client.shake_message(args[1])
+                message = self.client.shake_message(message)
             if self.client.disemvowel:
-                args[1] = self.client.disemvowel_message(args[1])
-            self.client.area.send_command('CT', self.client.name, args[1])
+                message = self.client.disemvowel_message(message)
+            self.client.area.send_command('CT', self.client.name, message)
             self.client.area.send_owner_command(
                 'CT',
                 '[' + self.client.area.abbreviation + ']' + self.client.name,
-                args[1])
-            database.log_room('ooc', self.client, self.client.area, message=args[1])
+                message)
+            database.log_room('ooc', self.client, self.client.area, message=message)
 
     def net_cmd_mc(self, args):
         """Play music.
@@ -682,13 +699,10 @@ class AOProtocol(asyncio.Protocol):
                     "You are not on the area's invite list, and thus, you cannot change music!"
                 )
                 return
-            if not self.validate_net_cmd(
-                    args, self.ArgType.STR,
-                    self.ArgType.INT) and not self.validate_net_cmd(
-                        args, self.ArgType.STR, self.ArgType.INT,
-                        self.ArgType.STR):
+            record = self.decode_net_cmd('MC', args)
+            if record is None:
                 return
-            if args[1] != self.client.char_id:
+            if record.char_id != self.client.char_id:
                 return
             if self.client.change_music_cd():
                 self.client.send_ooc(
@@ -696,7 +710,7 @@ class AOProtocol(asyncio.Protocol):
                     .format(int(self.client.change_music_cd())))
                 return
             try:
-                name, length = self.server.get_song_data(args[0])
+                name, length = self.server.get_song_data(record.name)
 
                 if self.client.area.jukebox:
                     showname = ''
@@ -758,15 +772,14 @@ class AOProtocol(asyncio.Protocol):
                 "You are not on the area's invite list, and thus, you cannot use the WTCE buttons!"
             )
             return
-        if not self.validate_net_cmd(
-                args, self.ArgType.STR) and not self.validate_net_cmd(
-                    args, self.ArgType.STR, self.ArgType.INT):
+        args = self.decode_net_cmd('RT', args)
+        if args is None:
             return
-        if args[0] == 'testimony1':
+        if args.animation == 'testimony1':
             sign = 'WT'
-        elif args[0] == 'testimony2':
+        elif args.animation == 'testimony2':
             sign = 'CE'
-        elif args[0] == 'judgeruling':
+        elif args.animation == 'judgeruling':
             sign = 'JR'
         else:
             return
@@ -775,10 +788,10 @@ class AOProtocol(asyncio.Protocol):
                 'You used witness testimony/cross examination signs too many times. Please try again after {} seconds.'
                 .format(int(self.client.wtce_mute())))
             return
-        if len(args) == 1:
-            self.client.area.send_command('RT', args[0])
-        elif len(args) == 2:
-            self.client.area.send_command('RT', args[0], args[1])
+        if args.variant is None:
+            self.client.area.send_command('RT', args.animation)
+        else:
+            self.client.area.send_command('RT', args.animation, args.variant)
         self.client.area.add_to_judgelog(self.client, f'used {sign}')
         database.log_room('wtce', self.client, self.client.area, message=sign)
 
@@ -857,10 +870,11 @@ class AOProtocol(asyncio.Protocol):
                 "You are not on the area's invite list, and thus, you cannot change the Confidence bars!"
             )
             return
-        if not self.validate_net_cmd(args, self.ArgType.INT, self.ArgType.INT):
+        args = self.decode_net_cmd('HP', args)
+        if args is None:
             return
         try:
-            self.client.area.change_hp(args[0], args[1])
+            self.client.area.change_hp(args.side, args.value)
             self.client.area.add_to_judgelog(self.client,
                                              'changed the penalties')
             database.log_room('hp', self.client, self.client.area)
@@ -28,8 +28,19 @@ class AOProtocolWS(AOProtocol):
     class TransportWrapper:
         """A class to wrap asyncio's Transport class."""
 
-        def __init__(self, websocket):
+        def __init__(self, websocket, protocol):
             self.ws = websocket
+            self.protocol = protocol
+            self.pending = []
+            self.pending_ready = asyncio.Event()
+            self.buffer_size = 0
+            self.high_water = 65536
+            self.low_water = 16384
+            self.paused = False
+            self.closing = False
+            self.reading = asyncio.Event()
+            self.reading.set()
+            self.sender = asyncio.ensure_future(self.ws_send_pending())
 
         def get_extra_info(self, key):
             """Get extra info about the client.
@@ -41,28 +52,90 @@ class AOProtocolWS(AOProtocol):
             info = {'peername': self.ws.remote_address}
             return info[key]
 
+        def get_write_buffer_size(self):
+            """Get the number of bytes that have not been sent yet."""
+            return self.buffer_size
+
+        def set_write_buffer_limits(self, high=None, low=None):
+            """Set the watermarks used to pause and resume the protocol.
+
+            :param high: pause writing above this many bytes
+            :param low: resume writing below this many bytes
+
+            """
+            if high is not None:
+                self.high_water = high
+            if low is not None:
+                self.low_water = low
+
+        def is_closing(self):
+            """Whether or not the connection is closing."""
+            return self.closing
+
+        def pause_reading(self):
+            """Stop handing incoming messages to the protocol."""
+            self.reading.clear()
+
+        def resume_reading(self):
+            """Start handing incoming messages to the protocol again."""
+            self.reading.set()
+
         def write(self, message):
-            """Write message to the socket.
+            """Queue a message to be sent by the sender task.
 
             :param message: message in bytes
 
             """
-            message = message.decode('utf-8')
-            asyncio.ensure_future(self.ws_try_writing_message(message))
+            if self.closing:
+                return
+            self.pending.append(message)
+            self.buffer_size += len(message)
+            if not self.paused and self.buffer_size > self.high_water:
+                self.paused = True
+                self.protocol.pause_writing()
+            self.pending_ready.set()
 
         def close(self):
-            """Disconnect the client by force."""
-            asyncio.ensure_future(self.ws.close())
-
-        async def ws_try_writing_message(self, message):
+            """Disconnect the client once all queued messages are sent."""
+            self.closing = True
+            self.pending_ready.set()
+            # Wake up the reader, even if reading was paused.
+            self.reading.set()
+
+        def abort(self):
+            """Disconnect the client without sending queued messages."""
+            self.buffer_size -= sum(len(message) for message in self.pending)
+            self.pending = []
+            self.close()
+
+        async def ws_send_pending(self):
             """
-            Try writing the message if the client has not already closed
-            the connection.
+            Send queued messages in order for as long as the connection is
+            open. Everything queued while the previous frame was being sent
+            goes out together in the next frame.
             """
             try:
-                await self.ws.send(message)
+                while True:
+                    if not self.pending:
+                        if self.closing:
+                            break
+                        await self.pending_ready.wait()
+                        self.pending_ready.clear()
+                        continue
+                    batch = b''.join(self.pending)
+                    self.pending = []
+                    try:
+                        await self.ws.send(batch.decode('utf-8'))
+                    finally:
+                        self.buffer_size -= len(batch)
+                    if self.paused and self.buffer_size <= self.low_water:
+                        self.paused = False
+                        self.protocol.resume_writing()
             except ConnectionClosed:
+                self.closing = True
+                self.pending = []
                 return
+            await self.ws.close()
 
     def __init__(self, server, websocket):
         super().__init__(server)
@@ -73,15 +146,24 @@ class AOProtocolWS(AOProtocol):
 
     def ws_on_connect(self):
         """Handle a new client connection."""
-        self.connection_made(self.TransportWrapper(self.ws))
+        self.transport = self.TransportWrapper(self.ws, self)
+        self.connection_made(self.transport)
 
     async def ws_handle(self):
         try:
+            await self.transport.reading.wait()
+            if self.client is None and self.transport.is_closing():
+                # Turned away before becoming a client, so there is
+                # nothing left to read.
+                self.ws_connected = False
+                self.connection_lost(None)
+                return
             data = await self.ws.recv()
             self.data_received(data)
         except Exception as exc:
             # Any event handled in data_received could raise any exception
             self.ws_connected = False
+            self.transport.abort()
             self.connection_lost(exc)
 
 
@@ -0,0 +1,148 @@
+# tsuserver3, an Attorney Online server
+#
+# Copyright (C) 2016 argoneus <argoneuscze@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from collections import namedtuple
+from enum import Enum
+
+
+class ArgType(Enum):
+    """Represents the data type of an argument for a network command."""
+    STR = 1
+    STR_OR_EMPTY = 2
+    INT = 3
+    INT_OR_STR = 4
+
+
+# Allowed values for integer fields that only need to be non-negative.
+NON_NEGATIVE = range(0, 2**63)
+
+
+class PacketSchema:
+    """
+    Describes the accepted layouts ("shapes") of an incoming packet.
+
+    Each shape is a list of `(name, ArgType)` or `(name, ArgType, allowed)`
+    fields. Shapes are told apart by their number of fields, and all of
+    them decode into the same record type; fields missing from a shape
+    take the value given in `defaults`.
+    """
+
+    def __init__(self, name, *shapes, defaults=None, needs_auth=True):
+        self.needs_auth = needs_auth
+        defaults = defaults or {}
+        names = []
+        for shape in shapes:
+            for field in shape:
+                if field[0] not in names:
+                    names.append(field[0])
+        self.record = namedtuple(name, names)
+        self.shapes = {}
+        for shape in shapes:
+            template = [defaults.get(field_name) for field_name in names]
+            decoders = tuple((names.index(field[0]), self.compile_field(*field[1:]))
+                             for field in shape)
+            self.shapes[len(shape)] = (template, decoders)
+
+    @staticmethod
+    def compile_field(arg_type, allowed=None):
+        """
+        Build a function that decodes and checks a single argument,
+        raising ValueError if it does not fit.
+        :param arg_type: data type of the argument
+        :param allowed: container of allowed values (Default value = None)
+        """
+        allow_empty = arg_type == ArgType.STR_OR_EMPTY
+        to_int = arg_type == ArgType.INT
+
+        def decode(arg):
+            if not arg and not allow_empty:
+                raise ValueError
+            value = int(arg) if to_int else arg
+            if allowed is not None and value not in allowed:
+                raise ValueError
+            return value
+
+        return decode
+
+    def decode(self, args):
+        """
+        Decode and check the arguments of a packet in a single pass.
+        :param args: list of raw arguments
+        :returns: a record, or None if the arguments match no shape
+        """
+        try:
+            template, decoders = self.shapes[len(args)]
+        except KeyError:
+            return None
+        values = list(template)
+        try:
+            for (index, decode), arg in zip(decoders, args):
+                values[index] = decode(arg)
+        except ValueError:
+            return None
+        return self.record._make(values)
+
+
+# Fields shared by every version of the IC message packet.
+_MS_FIELDS = [
+    ('msg_type', ArgType.STR, ('chat', '0', '1')),
+    ('pre', ArgType.STR_OR_EMPTY),
+    ('folder', ArgType.STR),
+    ('anim', ArgType.STR),
+    ('text', ArgType.STR),
+    ('pos', ArgType.STR),
+    ('sfx', ArgType.STR),
+    ('anim_type', ArgType.INT, (0, 1, 2, 5, 6)),
+    ('cid', ArgType.INT),
+    ('sfx_delay', ArgType.INT, NON_NEGATIVE),
+    ('button', ArgType.INT_OR_STR),
+    ('evidence', ArgType.INT, NON_NEGATIVE),
+    ('flip', ArgType.INT),
+    ('ding', ArgType.INT, (0, 1)),
+    ('color', ArgType.INT, range(0, 9)),
+]
+
+# Schemas of the network commands that take arguments. Commands not listed
+# here either take no arguments or read them as free-form text.
+SCHEMAS = {
+    'HI': PacketSchema('HI', [('hdid', ArgType.STR)], needs_auth=False),
+    'AN': PacketSchema('AN', [('page', ArgType.INT)], needs_auth=False),
+    'AM': PacketSchema('AM', [('page', ArgType.INT)], needs_auth=False),
+    'CC': PacketSchema('CC', [('client_id', ArgType.INT),
+                              ('char_id', ArgType.INT),
+                              ('hdid', ArgType.STR)], needs_auth=False),
+    'MS': PacketSchema(
+        'MS',
+        # Pre-2.6
+        _MS_FIELDS,
+        # 2.6+
+        _MS_FIELDS + [('showname', ArgType.STR_OR_EMPTY),
+                      ('charid_pair', ArgType.INT),
+                      ('offset_pair', ArgType.INT),
+                      ('nonint_pre', ArgType.INT)],
+        defaults={'showname': '', 'charid_pair': -1, 'offset_pair': 0,
+                  'nonint_pre': 0}),
+    'CT': PacketSchema('CT', [('name', ArgType.STR),
+                              ('message', ArgType.STR)]),
+    'MC': PacketSchema('MC', [('name', ArgType.STR), ('char_id', ArgType.INT)],
+                       [('name', ArgType.STR), ('char_id', ArgType.INT),
+                        ('showname', ArgType.STR)]),
+    'RT': PacketSchema('RT', [('animation', ArgType.STR)],
+                       [('animation', ArgType.STR),
+                        ('variant', ArgType.INT)]),
+    'HP': PacketSchema('HP', [('side', ArgType.INT), ('value', ArgType.INT)]),
+}
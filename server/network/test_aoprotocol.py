@@ -0,0 +1,21 @@
+from server.network.aoprotocol import AOProtocol
+
+
+def feed(protocol, data):
+    protocol.buffer += data
+    return list(protocol.get_messages())
+
+
+def test_get_messages_split_terminator():
+    protocol = AOProtocol(None)
+    assert feed(protocol, b'HI#abc#') == []
+    assert feed(protocol, b'%CH#%ID') == ['HI#abc', 'CH']
+    assert feed(protocol, b'#2.8#%') == ['ID#2.8']
+    assert protocol.buffer == b''
+
+
+def test_get_messages_split_multibyte():
+    protocol = AOProtocol(None)
+    data = 'CT#name#café あ#%'.encode('utf-8')
+    assert feed(protocol, data[:12]) == []
+    assert feed(protocol, data[12:]) == ['CT#name#café あ']
@@ -0,0 +1,25 @@
+from server.network.packets import SCHEMAS
+
+
+def test_decode_ms_pre_26():
+    args = 'chat#-#Phoenix#normal#hi#def#0#0#1#0#0#0#0#0#0'.split('#')
+    record = SCHEMAS['MS'].decode(args)
+    assert record.cid == 1
+    assert record.text == 'hi'
+    assert record.showname == ''
+    assert record.charid_pair == -1
+
+
+def test_decode_ms_26():
+    args = 'chat#-#Phoenix#normal#hi#def#0#0#1#0#0#0#0#0#3#Nick#-1#0#0'.split('#')
+    record = SCHEMAS['MS'].decode(args)
+    assert record.color == 3
+    assert record.showname == 'Nick'
+
+
+def test_decode_rejects_bad_fields():
+    args = 'chat#-#Phoenix#normal#hi#def#0#3#1#0#0#0#0#0#0'.split('#')
+    assert SCHEMAS['MS'].decode(args) is None  # anim_type out of range
+    assert SCHEMAS['HP'].decode(['1', 'x']) is None
+    assert SCHEMAS['HP'].decode(['1']) is None
+    assert SCHEMAS['HI'].decode(['']) is None
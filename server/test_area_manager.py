@@ -0,0 +1,107 @@
+import asyncio
+import time
+
+import pytest
+
+from server.exceptions import AreaError
+
+
+def test_char_holders_follow_clients(tsuserver, connect):
+    areas = tsuserver.area_manager
+    basement, courtroom = areas.get_area_by_id(0), areas.get_area_by_id(1)
+    apollo = tsuserver.char_list.index('Apollo')
+    april = tsuserver.char_list.index('April')
+    client = connect()
+    client.change_character(apollo)
+    assert basement.char_holders == {apollo: client}
+    assert basement.get_char_status()[apollo] == -1
+    assert not basement.is_char_available(apollo)
+
+    client.change_character(april)
+    assert basement.char_holders == {april: client}
+    assert basement.get_char_status()[apollo] == 0
+
+    client.change_area(courtroom)
+    assert basement.char_holders == {}
+    assert basement.get_char_status()[april] == 0
+    assert courtroom.char_holders == {april: client}
+    assert courtroom.get_char_status()[april] == -1
+
+    # Someone else holding the character makes the client switch.
+    other = connect()
+    other.change_character(april)
+    client.change_area(basement)
+    assert basement.char_holders[april] is other
+    assert client.char_id not in (-1, april)
+    assert basement.char_holders[client.char_id] is client
+    by_char_name = tsuserver.client_manager.clients_by_char_name
+    assert by_char_name['april'] == {other}
+    assert by_char_name[client.char_name.lower()] == {client}
+
+    tsuserver.remove_client(client)
+    tsuserver.remove_client(other)
+    assert basement.char_holders == {}
+    assert basement.get_char_status().count(-1) == 0
+    assert by_char_name == {}
+
+
+def test_find_area(tsuserver):
+    areas = tsuserver.area_manager
+    courtroom = areas.get_area_by_name('Courtroom 1')
+    assert areas.find_area('1') is courtroom
+    assert areas.find_area('CR1') is courtroom
+    assert areas.find_area('cr1') is courtroom
+    assert areas.find_area('COURTROOM 1') is courtroom
+    assert areas.get_area_by_id(1) is courtroom
+    with pytest.raises(AreaError):
+        areas.find_area('Courtroom 9')
+    with pytest.raises(AreaError):
+        areas.get_area_by_name('courtroom 1')
+
+
+def test_arup_updates_are_merged(tsuserver, connect, monkeypatch):
+    areas = tsuserver.area_manager
+    sent = []
+    monkeypatch.setattr(tsuserver, 'send_arup', sent.append)
+
+    def players_packets():
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(asyncio.sleep(
+            tsuserver.config['arup_interval_ms'] / 1000 + 0.05))
+        packets = [args for args in sent if args[0] == areas.ARUP_PLAYERS]
+        sent.clear()
+        return packets
+
+    first = connect()
+    second = connect()
+    second.change_area(areas.get_area_by_id(1))
+    assert players_packets() == [[areas.ARUP_PLAYERS, 1, 1, 0, 0]]
+
+    # Changes that cancel out, or no change at all, send nothing.
+    second.change_area(areas.get_area_by_id(2))
+    second.change_area(areas.get_area_by_id(1))
+    areas.send_arup_players()
+    assert players_packets() == []
+
+    tsuserver.remove_client(second)
+    assert players_packets() == [[areas.ARUP_PLAYERS, 1, 0, 0, 0]]
+    tsuserver.remove_client(first)
+
+
+def test_dropped_arup_is_resent(tsuserver, connect):
+    client = connect()
+    client.congested_since = time.time()
+    tsuserver.client_manager.broadcast_command(
+        [client], 'ARUP', 0, 1, 0, 0, 0)
+    assert client.out_buffer == []
+    assert client.dropped_while_congested == 1
+
+    # Once the client has caught up, it is sent the state of every area.
+    client.check_send_queue()
+    assert client.congested_since is None
+    assert client.dropped_while_congested == 0
+    arups = [packet for packet in client.out_buffer
+             if packet.startswith(b'ARUP#')]
+    assert len(arups) == 4
+    assert arups[0] == b'ARUP#0#1#0#0#0#%'
+    tsuserver.remove_client(client)
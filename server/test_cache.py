@@ -0,0 +1,32 @@
+from server.cache import LRUCache
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+def test_evicts_least_recently_used():
+    cache = LRUCache(2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    assert cache.get('a') == 1
+    cache.put('c', 3)
+    assert 'a' in cache
+    assert 'b' not in cache
+    assert cache.get('c') == 3
+    assert len(cache) == 2
+
+
+def test_entries_expire():
+    clock = FakeClock()
+    cache = LRUCache(8, ttl=10, clock=clock)
+    cache.put('a', 1)
+    clock.now = 9
+    assert cache.get('a') == 1
+    clock.now = 10
+    assert cache.get('a') is None
+    assert len(cache) == 0
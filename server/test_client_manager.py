@@ -0,0 +1,71 @@
+from server.constants import TargetType
+
+
+def test_setters_update_indexes(tsuserver, connect):
+    manager = tsuserver.client_manager
+    client = connect()
+    client.name = 'Phoenix Wright'
+    client.hdid = 'hdid'
+    client.change_character(tsuserver.char_list.index('Apollo'))
+    assert manager.clients_by_id[client.id] is client
+    assert manager.clients_by_ipid[client.ipid] == {client}
+    assert manager.clients_by_name['phoenix wright'] == {client}
+    assert manager.clients_by_hdid['hdid'] == {client}
+    assert manager.clients_by_char_name['apollo'] == {client}
+
+    client.name = 'Edgeworth'
+    client.hdid = 'other'
+    client.change_character(tsuserver.char_list.index('April'))
+    assert 'phoenix wright' not in manager.clients_by_name
+    assert 'hdid' not in manager.clients_by_hdid
+    assert 'apollo' not in manager.clients_by_char_name
+    assert manager.clients_by_name['edgeworth'] == {client}
+    assert manager.clients_by_hdid['other'] == {client}
+    assert manager.clients_by_char_name['april'] == {client}
+
+    tsuserver.remove_client(client)
+    assert manager.clients_by_id == {}
+    assert manager.clients_by_ipid == {}
+    assert manager.clients_by_name == {}
+    assert manager.clients_by_hdid == {}
+    assert manager.clients_by_char_name == {}
+
+
+def test_get_targets(tsuserver, connect):
+    manager = tsuserver.client_manager
+    phoenix = connect('10.0.0.1')
+    phoenix.name = 'Phoenix'
+    wright = connect('10.0.0.1')
+    wright.name = 'Phoenix Wright'
+    other = connect('10.0.0.2')
+    other.hdid = 'hdid'
+    other.change_area(tsuserver.area_manager.get_area_by_id(1))
+
+    assert manager.get_targets(phoenix, TargetType.OOC_NAME,
+                               'phoenix wright hello') == [wright, phoenix]
+    assert set(manager.get_targets(phoenix, TargetType.IPID,
+                                   phoenix.ipid)) == {phoenix, wright}
+    assert manager.get_targets(phoenix, TargetType.HDID, 'hdid') == [other]
+    assert manager.get_targets(phoenix, TargetType.ID, other.id) == [other]
+    assert manager.get_targets(phoenix, TargetType.HDID, 'hdid',
+                               local=True) == []
+
+
+def test_connections_per_ipid(tsuserver, connect):
+    manager = tsuserver.client_manager
+    tsuserver.config['multiclient_limit'] = 2
+    clients = [connect('10.0.0.1') for _ in range(2)]
+    other = connect('10.0.0.2')
+    ipid = clients[0].ipid
+    assert manager.ipid_connections == {ipid: 2, other.ipid: 1}
+    assert manager.new_client_preauth(clients[1])
+
+    clients.append(connect('10.0.0.1'))
+    assert manager.ipid_connections[ipid] == 3
+    assert not manager.new_client_preauth(clients[2])
+
+    tsuserver.remove_client(clients.pop())
+    assert manager.new_client_preauth(clients[1])
+    for client in clients + [other]:
+        tsuserver.remove_client(client)
+    assert manager.ipid_connections == {}
@@ -0,0 +1,158 @@
+import asyncio
+import os
+import threading
+from glob import glob
+from types import SimpleNamespace
+
+import pytest
+
+from server import database
+from server.exceptions import ArgumentError, ServerError
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    os.symlink(os.path.join(root, 'migrations'), tmp_path / 'migrations')
+    os.mkdir(tmp_path / 'storage')
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+@pytest.fixture
+def db(workdir):
+    db = database.Database()
+    yield db
+    db.close()
+
+
+def moderator(db):
+    return SimpleNamespace(name='mod', ipid=db.ipid('10.0.0.1'))
+
+
+def test_ban_while_logging(db):
+    mod = moderator(db)
+    ipid = db.ipid('10.0.0.2')
+    stop = threading.Event()
+
+    def log_forever():
+        while not stop.is_set():
+            db.log_misc('spam', data={'ipid': ipid})
+
+    producer = threading.Thread(target=log_forever)
+    producer.start()
+    try:
+        db.add_hdid(ipid, 'hdid')
+        ban_ids = []
+        banning = threading.Thread(target=lambda: ban_ids.append(
+            db.insert_ban('hdid', 'spam', 'hdid', mod)))
+        banning.start()
+        banning.join(timeout=10)
+        assert not banning.is_alive()
+    finally:
+        stop.set()
+        producer.join()
+    assert ban_ids
+    row = db.db.execute('SELECT ban_id FROM hdid_bans WHERE hdid = ?',
+                        ('hdid',)).fetchone()
+    assert row['ban_id'] == ban_ids[0]
+
+
+def test_close_commits_queued_writes(db):
+    ipid = db.ipid('10.0.0.2')
+    for i in range(2000):
+        db.log_misc('spam', data={'n': i})
+    db.add_hdid(ipid, 'hdid')
+    db.close()
+    db.close()
+    assert db.db.execute('SELECT COUNT(*) FROM misc_events').fetchone()[0] == 2000
+    assert db.db.execute('SELECT ipid FROM hdids WHERE hdid = ?',
+                         ('hdid',)).fetchone()['ipid'] == ipid
+
+
+def test_new_ipid_is_read_back(db):
+    ipid = db.ipid('10.0.0.2')
+    assert db.db.execute('SELECT ipid FROM ipids WHERE ip_address = ?',
+                         ('10.0.0.2',)).fetchone()['ipid'] == ipid
+    # An address added by someone else since the IPIDs were loaded keeps
+    # the IPID it was given there.
+    with db.db as conn:
+        conn.execute('INSERT INTO ipids(ipid, ip_address) VALUES (?, ?)',
+                     (ipid + 10, '10.0.0.3'))
+    assert db.ipid('10.0.0.3') == ipid + 10
+    assert db.ipid('10.0.0.4') == ipid + 11
+
+
+def test_aio_only_forwards_thread_safe_methods(db):
+    with pytest.raises(AttributeError):
+        db.aio.unban
+    with pytest.raises(AttributeError):
+        db.aio.schedule_unbans
+
+    async def lookup():
+        return await db.aio.find_ban(ipid=1)
+    assert asyncio.run(lookup()) is None
+
+
+def test_find_ban_and_unban_keep_index(db):
+    mod = moderator(db)
+    ipid = db.ipid('10.0.0.2')
+    db.add_hdid(ipid, 'hdid')
+    ban_id = db.ban(ipid, 'spam', 'ipid', mod)
+    db.ban('hdid', 'spam', 'hdid', ban_id=ban_id)
+    assert db.ip_bans == {ipid: ban_id}
+    assert db.hdid_bans == {'hdid': ban_id}
+    assert db.find_ban(ipid=str(ipid)).ban_id == ban_id
+    assert db.find_ban(hdid='hdid').ban_id == ban_id
+    assert db.find_ban(ipid=mod.ipid, hdid='other') is None
+
+    with pytest.raises(ArgumentError):
+        db.unban('first')
+    assert db.unban(str(ban_id))
+    assert db.ip_bans == {}
+    assert db.hdid_bans == {}
+    assert db.find_ban(ipid=ipid, hdid='hdid') is None
+    assert not db.unban(ban_id)
+
+
+def test_archive_events(db):
+    ipid = db.ipid('10.0.0.2')
+    subtype = db._subtype_atom('room', 'ooc')
+    db.flush()
+    with db.db as conn:
+        conn.executemany(
+            'INSERT INTO room_events(event_time, ipid, room_name, ooc_name, '
+            'event_subtype) VALUES (?, ?, ?, ?, ?)',
+            [('2020-01-01 00:00:00', ipid, 'CR1', 'old', subtype),
+             ('2020-02-01 00:00:00', ipid, 'CR1', 'older', subtype),
+             (db._timestamp(), ipid, 'CR1', 'new', subtype)])
+    assert db.archive_events(30, batch_size=1) == 2
+
+    names = [row['ooc_name'] for row in
+             db.db.execute('SELECT ooc_name FROM room_events')]
+    assert names == ['new']
+    months = [os.path.basename(path) for path in
+              sorted(glob(os.path.join(database.ARCHIVE_DIR, '*')))]
+    assert months == ['events-2020-01.sqlite3', 'events-2020-02.sqlite3']
+    with db.db as conn:
+        conn.execute('DELETE FROM room_events')
+    assert db.last_known_name(ipid) is None
+    assert db.last_known_name(ipid, search_archives=True) == 'older'
+
+
+def test_setup_replaces_open_database(workdir, monkeypatch):
+    monkeypatch.setattr(database, '_database_singleton', None)
+    database.setup({'cache_size': -2000})
+    first = database._database_singleton
+    assert first.db.execute('PRAGMA cache_size').fetchone()[0] == -2000
+    first.log_misc('spam')
+
+    database.setup()
+    assert not first.writer.is_alive()
+    assert database.db.execute(
+        'SELECT COUNT(*) FROM misc_events').fetchone()[0] == 1
+    # A bad profile still closes the database it replaces.
+    second = database._database_singleton
+    with pytest.raises(ServerError):
+        database.setup({'synchronous': 'sometimes'})
+    assert not second.writer.is_alive()
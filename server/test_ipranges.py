@@ -0,0 +1,56 @@
+from server.ipranges import IPRangeBans
+
+
+def make_bans(*lines):
+    bans = IPRangeBans()
+    for line, entry in enumerate(lines):
+        bans.add_entry(entry, line)
+    return bans
+
+
+def test_dotted_prefixes():
+    bans = make_bans('# comment', '107.189.10.', '104.244.7')
+    assert bans.find('107.189.10.3') == 1
+    assert bans.find('107.189.100.3') is None
+    assert bans.find('104.244.7.1') == 2
+    assert bans.find('104.244.75.1') == 2
+    assert bans.find('104.244.8.1') is None
+
+
+def test_cidr_and_ipv6():
+    bans = make_bans('185.220.100.0/22', '2001:db8::/32', '1.2.3.4/32')
+    assert bans.find('185.220.103.255') == 0
+    assert bans.find('185.220.104.0') is None
+    assert bans.find('2001:db8::1') == 1
+    assert bans.find('2001:db9::1') is None
+    assert bans.find('::ffff:1.2.3.4') == 2
+    assert bans.find('1.2.3.40') is None
+
+
+def test_addresses_match_as_prefixes():
+    bans = make_bans('179.186.123.15', '1.2.3.4.')
+    assert bans.find('179.186.123.15') == 0
+    assert bans.find('179.186.123.150') == 0
+    assert bans.find('179.186.123.159') == 0
+    assert bans.find('179.186.123.16') is None
+    assert bans.find('1.2.3.4') == 1
+    assert bans.find('1.2.3.40') is None
+
+
+def test_asn():
+    bans = make_bans('3223', '46')
+    assert bans.find('8.8.8.8', '3223') == 0
+    assert bans.find('8.8.8.8', '15169') is None
+    assert bans.find('46.1.2.3', '15169') == 1
+    assert bans.find('8.8.8.8', '46') == 1
+
+
+def test_invalid_entries_are_logged(caplog):
+    bans = make_bans('1.2.3.4', '2001:db8:', '300.1.')
+    assert bans.find('1.2.3.4') == 0
+    assert [record.getMessage() for record in caplog.records] == [
+        'Ignoring line 1 of the IP range ban list, '
+        'which is not a valid entry: 2001:db8:',
+        'Ignoring line 2 of the IP range ban list, '
+        'which is not a valid entry: 300.1.'
+    ]
@@ -18,13 +18,16 @@
 import sys
 import os
 import importlib
+import signal
 
 import asyncio
 import websockets
+from concurrent.futures import ThreadPoolExecutor
 
 import geoip2.database
 
 import json
+import sqlite3
 import yaml
 
 import logging
@@ -32,9 +35,11 @@ logger = logging.getLogger('debug')
 
 from server import database
 from server.area_manager import AreaManager
+from server.cache import LRUCache
 from server.client_manager import ClientManager
 from server.emotes import Emotes
 from server.exceptions import ClientError,ServerError
+from server.ipranges import IPRangeBans
 from server.network.aoprotocol import AOProtocol
 from server.network.aoprotocol_ws import new_websocket_client
 from server.network.masterserverclient import MasterServerClient
@@ -56,11 +61,18 @@ class TsuServer3:
         self.music_list = None
         self.music_list_ao2 = None
         self.music_pages_ao1 = None
+        self.char_list_packet = None
+        self.char_page_packets_ao1 = None
+        self.music_list_packet = None
+        self.music_page_packets_ao1 = None
+        self.list_sizes_packet = None
         self.backgrounds = None
         self.zalgo_tolerance = None
-        self.ipRange_bans = []
+        self.iprange_bans = IPRangeBans()
         self.geoIpReader = None
         self.useGeoIp = False
+        self.asn_cache = None
+        self.geoip_executor = None
 
         try:
             self.geoIpReader = geoip2.database.Reader('./storage/GeoLite2-ASN.mmdb')
@@ -89,8 +101,17 @@ class TsuServer3:
                 input('(Press Enter to exit)')
             sys.exit(1)
 
+        self.asn_cache = LRUCache(self.config['geoip_cache_size'],
+                                  self.config['geoip_cache_ttl'])
+        if self.useGeoIp and self.config['geoip_lookup_threads'] > 0:
+            self.geoip_executor = ThreadPoolExecutor(
+                max_workers=self.config['geoip_lookup_threads'],
+                thread_name_prefix='geoip')
+
         self.client_manager = ClientManager(self)
         server.logger.setup_logger(debug=self.config['debug'])
+        database.setup(self.config['database'])
+        database.configure_writer(**self.config['event_log'])
 
     def start(self):
         """Start the server."""
@@ -117,33 +138,55 @@ class TsuServer3:
         if self.config['zalgo_tolerance']:
             self.zalgo_tolerance = self.config['zalgo_tolerance']
 
-        asyncio.ensure_future(self.schedule_unbans())
+        database.schedule_unbans()
+        if self.config['log_retention']['days'] > 0:
+            asyncio.ensure_future(self.archive_events())
 
         database.log_misc('start')
         print('Server started and is listening on port {}'.format(
             self.config['port']))
 
+        # Stop cleanly on Ctrl+C and on SIGTERM from docker or systemd.
+        # Windows has no signal handlers in asyncio, so Ctrl+C still
+        # arrives there as a KeyboardInterrupt.
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(signum, loop.stop)
+            except NotImplementedError:
+                pass
+
         try:
             loop.run_forever()
         except KeyboardInterrupt:
             pass
-
-        database.log_misc('stop')
+        finally:
+            database.log_misc('stop')
+            database.close()
 
         ao_server.close()
         loop.run_until_complete(ao_server.wait_closed())
+        if self.geoip_executor is not None:
+            self.geoip_executor.shutdown(wait=False)
         loop.close()
 
-    async def schedule_unbans(self):
-        while True:
-            database.schedule_unbans()
-            await asyncio.sleep(3600 * 12)
-
     @property
     def version(self):
         """Get the server's current version."""
         return f'{self.release}.{self.major_version}.{self.minor_version}'
 
+    async def archive_events(self):
+        """Move old events out of the main database every so often."""
+        loop = asyncio.get_event_loop()
+        retention = self.config['log_retention']
+        while True:
+            try:
+                await loop.run_in_executor(None, database.archive_events,
+                                           retention['days'],
+                                           retention['batch_size'])
+            except (sqlite3.Error, OSError) as exc:
+                logger.error(f'Could not archive events: {exc}')
+            await asyncio.sleep(retention['interval'])
+
     def new_client(self, transport):
         """
         Create a new client based on a raw transport by passing
@@ -153,26 +196,16 @@ class TsuServer3:
         """
         peername = transport.get_extra_info('peername')[0]
 
-        if self.useGeoIp:
-            try:
-                geoIpResponse = self.geoIpReader.asn(peername)
-                asn = str(geoIpResponse.autonomous_system_number)
-            except geoip2.errors.AddressNotFoundError:
-                asn = "Loopback"
-                pass
-        else:
-            asn = "Loopback"
+        line = self.iprange_bans.find(peername, self.get_asn(peername))
+        if line is not None:
+            msg =   'BD#'
+            msg +=  'Abuse\r\n'
+            msg += f'ID: {line}\r\n'
+            msg +=  'Until: N/A'
+            msg +=  '#%'
 
-        for line,rangeBan in enumerate(self.ipRange_bans):
-            if rangeBan != "" and peername.startswith(rangeBan) or asn == rangeBan:
-                msg =   'BD#'
-                msg +=  'Abuse\r\n'
-                msg += f'ID: {line}\r\n'
-                msg +=  'Until: N/A'
-                msg +=  '#%'
-
-                transport.write(msg.encode('utf-8'))
-                raise ClientError
+            transport.write(msg.encode('utf-8'))
+            raise ClientError
 
         c = self.client_manager.new_client(transport)
         c.server = self
@@ -180,6 +213,53 @@ class TsuServer3:
         c.area.new_client(c)
         return c
 
+    def get_asn(self, ip):
+        """
+        Look up the autonomous system number of an IP address, using
+        the cache if the address was seen recently.
+        :param ip: IP address
+        :returns: ASN as a string, or "Loopback" if unknown
+        """
+        if not self.useGeoIp:
+            return "Loopback"
+        asn = self.asn_cache.get(ip)
+        if asn is None:
+            asn = self.lookup_asn(ip)
+            self.asn_cache.put(ip, asn)
+        return asn
+
+    def needs_asn_lookup(self, ip):
+        """
+        Whether or not the ASN of an IP address should be fetched with
+        `fetch_asn` before the client is let in.
+        :param ip: IP address
+        """
+        return self.geoip_executor is not None and ip not in self.asn_cache
+
+    async def fetch_asn(self, ip):
+        """
+        Look up the ASN of an IP address in a worker thread and cache it,
+        so that a following `get_asn` call does not touch the database.
+        :param ip: IP address
+        """
+        loop = asyncio.get_event_loop()
+        asn = await loop.run_in_executor(self.geoip_executor,
+                                         self.lookup_asn, ip)
+        self.asn_cache.put(ip, asn)
+        return asn
+
+    def lookup_asn(self, ip):
+        """
+        Read the ASN of an IP address from the GeoIP database.
+        This does not use the cache and is safe to call from any thread.
+        :param ip: IP address
+        """
+        try:
+            geoIpResponse = self.geoIpReader.asn(ip)
+            return str(geoIpResponse.autonomous_system_number)
+        except (geoip2.errors.AddressNotFoundError, ValueError):
+            return "Loopback"
+
     def remove_client(self, client):
         """
         Remove a disconnected client.
@@ -213,6 +293,15 @@ class TsuServer3:
                 'mute_length': 0
             }
 
+        if 'send_queue' not in self.config:
+            self.config['send_queue'] = {
+                'high_watermark': 65536,
+                'low_watermark': 16384,
+                'max_size': 1048576,
+                'evict_after': 30,
+                'drop_commands': ['ARUP']
+            }
+
         if 'zalgo_tolerance' not in self.config:
             self.config['zalgo_tolerance'] = 3
 
@@ -220,12 +309,37 @@ class TsuServer3:
             self.config['modpass'] = {'default': {'password': self.config['modpass']}}
         if 'multiclient_limit' not in self.config:
             self.config['multiclient_limit'] = 16
+        if 'arup_interval_ms' not in self.config:
+            self.config['arup_interval_ms'] = 100
+        if 'geoip_cache_size' not in self.config:
+            self.config['geoip_cache_size'] = 4096
+        if 'geoip_cache_ttl' not in self.config:
+            self.config['geoip_cache_ttl'] = 3600
+        if 'geoip_lookup_threads' not in self.config:
+            self.config['geoip_lookup_threads'] = 0
+        if 'database' not in self.config:
+            self.config['database'] = {}
+        if 'log_retention' not in self.config:
+            self.config['log_retention'] = {
+                'days': 0,
+                'batch_size': 1000,
+                'interval': 3600
+            }
+        if 'event_log' not in self.config:
+            self.config['event_log'] = {
+                'interval_ms': 100,
+                'batch_size': 500,
+                'max_queued': 50000
+            }
 
     def load_characters(self):
         """Load the character list from a YAML file."""
         with open('config/characters.yaml', 'r', encoding='utf-8') as chars:
             self.char_list = yaml.safe_load(chars)
         self.build_char_pages_ao1()
+        self.char_list_packet = ClientManager.Client.encode_command(
+            'SC', *self.char_list)
+        self.build_list_sizes_packet()
         self.char_emotes = {char: Emotes(char) for char in self.char_list}
 
     def load_music(self):
@@ -234,6 +348,7 @@ class TsuServer3:
             self.music_list = yaml.safe_load(music)
         self.build_music_pages_ao1()
         self.build_music_list_ao2()
+        self.build_list_sizes_packet()
 
     def load_backgrounds(self):
         """Load the backgrounds list from a YAML file."""
@@ -252,10 +367,8 @@ class TsuServer3:
     def load_ipranges(self):
         """Load a list of banned IP ranges."""
         try:
-            with open('config/iprange_ban.txt', 'r',
-                      encoding='utf-8') as ipranges:
-                self.ipRange_bans = ipranges.read().splitlines()
-        except:
+            self.iprange_bans = IPRangeBans.load('config/iprange_ban.txt')
+        except OSError:
             logger.debug('Cannot find iprange_ban.txt')
 
     def build_char_pages_ao1(self):
@@ -269,6 +382,10 @@ class TsuServer3:
         for i in range(len(self.char_list)):
             self.char_pages_ao1[i // 10][i % 10] = '{}#{}&&0&&&0&'.format(
                 i, self.char_list[i])
+        self.char_page_packets_ao1 = [
+            ClientManager.Client.encode_command('CI', *page)
+            for page in self.char_pages_ao1
+        ]
 
     def build_music_pages_ao1(self):
         """
@@ -294,6 +411,10 @@ class TsuServer3:
             self.music_pages_ao1[x:x + 10]
             for x in range(0, len(self.music_pages_ao1), 10)
         ]
+        self.music_page_packets_ao1 = [
+            ClientManager.Client.encode_command('EM', *page)
+            for page in self.music_pages_ao1
+        ]
 
     def build_music_list_ao2(self):
         """
@@ -309,6 +430,21 @@ class TsuServer3:
             self.music_list_ao2.append(item['category'])
             for song in item['songs']:
                 self.music_list_ao2.append(song['name'])
+        self.music_list_packet = ClientManager.Client.encode_command(
+            'SM', *self.music_list_ao2)
+
+    def build_list_sizes_packet(self):
+        """
+        Cache the character, evidence and music counts sent to AO1
+        clients at the start of the connection handshake.
+        """
+        if self.char_list is None or self.music_pages_ao1 is None:
+            return
+        char_cnt = len(self.char_list)
+        evi_cnt = 0
+        music_cnt = sum([len(x) for x in self.music_pages_ao1])
+        self.list_sizes_packet = ClientManager.Client.encode_command(
+            'SI', char_cnt, evi_cnt, music_cnt)
 
     def is_valid_char_id(self, char_id):
         """
@@ -354,9 +490,9 @@ class TsuServer3:
         Broadcast an AO-compatible command to all clients that satisfy
         a predicate.
         """
-        for client in self.client_manager.clients:
-            if pred(client):
-                client.send_command(cmd, *args)
+        self.client_manager.broadcast_command(
+            [client for client in self.client_manager.clients if pred(client)],
+            cmd, *args)
 
     def broadcast_global(self, client, msg, as_mod=False):
         """
@@ -480,6 +616,7 @@ class TsuServer3:
             self.config['modpass'] = cfg_yaml['modpass']
 
         self.load_characters()
+        self.client_manager.reindex_char_names()
         self.load_iniswaps()
         self.load_music()
         self.load_backgrounds()